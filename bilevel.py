@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# PDFCutter
+#
+# Copyright (C) 2009, Benjamin Berg <benjamin@sipsolutions.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Conversion of rendered surfaces to black and white rows for tiff.
+
+NumPy is used if it is available, otherwise the rows are converted with
+string operations, and ordered dithering falls back to a plain threshold."""
+
+import sys
+from tiff import WHITE, BLACK
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+# The conversion modes
+THRESHOLD = 'threshold'
+OTSU = 'otsu'
+DITHER = 'dither'
+
+# Size of the Bayer matrix used for ordered dithering
+DITHER_SIZE = 8
+
+def _threshold_table(threshold):
+	return ''.join([BLACK if i < threshold else WHITE for i in xrange(256)])
+
+def otsu_threshold(histogram, default=128):
+	"""Returns the threshold that separates black and white best in a
+	histogram of 256 values, or default if it cannot be split."""
+	total = sum(histogram)
+	sum_all = sum(i * count for i, count in enumerate(histogram))
+
+	best = None
+	best_variance = 0
+	weight = 0
+	sum_black = 0
+	for i, count in enumerate(histogram):
+		weight += count
+		sum_black += i * count
+		if weight == 0 or weight == total:
+			continue
+		mean_black = sum_black / float(weight)
+		mean_white = (sum_all - sum_black) / float(total - weight)
+		variance = weight * (total - weight) * (mean_black - mean_white) ** 2
+		if variance > best_variance:
+			best = i + 1
+			best_variance = variance
+
+	# A single colour cannot be split
+	if best is None:
+		return default
+	return best
+
+def _bayer_matrix(size):
+	matrix = numpy.array([[0, 2], [3, 1]])
+	while matrix.shape[0] < size:
+		matrix = numpy.vstack([numpy.hstack([4 * matrix, 4 * matrix + 2]),
+		                       numpy.hstack([4 * matrix + 3, 4 * matrix + 1])])
+	return (matrix + 0.5) * (256.0 / matrix.size)
+
+def _green_offset():
+	# Pixels are native endian 32 bit words, green is the second byte
+	# either way round
+	return 1 if sys.byteorder == 'little' else 2
+
+def _numpy_green(surface):
+	# A view on the green channel, the data is not copied
+	width = surface.get_width()
+	height = surface.get_height()
+	stride = surface.get_stride()
+	green = _green_offset()
+
+	data = numpy.frombuffer(surface.get_data(), dtype=numpy.uint8)
+	data = data[:height * stride].reshape(height, stride)
+	return data[:, green:green + width * 4:4]
+
+def _string_green(surface):
+	width = surface.get_width()
+	stride = surface.get_stride()
+	green = _green_offset()
+	data = surface.get_data()
+
+	for y in xrange(surface.get_height()):
+		start = y * stride + green
+		yield data[start:start + width * 4:4]
+
+def get_histogram(surface):
+	"""Returns how often each of the 256 values of the green channel occurs
+	in an RGB24 surface."""
+	if numpy is not None:
+		return numpy.bincount(_numpy_green(surface).ravel(), minlength=256).tolist()
+
+	channel = ''.join(_string_green(surface))
+	return [channel.count(chr(i)) for i in xrange(256)]
+
+def _numpy_rows(surface, mode, threshold, y):
+	data = _numpy_green(surface)
+	height, width = data.shape
+
+	if mode == DITHER:
+		# The matrix continues where the previous band stopped
+		matrix = _bayer_matrix(DITHER_SIZE)
+		rows = (numpy.arange(height) + y) % DITHER_SIZE
+		columns = numpy.arange(width) % DITHER_SIZE
+		black = data < matrix[rows[:, numpy.newaxis], columns[numpy.newaxis, :]]
+	else:
+		black = data < threshold
+
+	# The bytes of a boolean array are BLACK and WHITE already
+	black = black.view(numpy.uint8)
+	for row in xrange(height):
+		yield black[row].tostring()
+
+def _string_rows(surface, mode, threshold, y):
+	table = _threshold_table(threshold)
+	for row in _string_green(surface):
+		yield row.translate(table)
+
+def convert_rows(surface, mode=THRESHOLD, threshold=128, y=0):
+	"""Yields the rows of an RGB24 surface as strings of WHITE and BLACK.
+
+	With THRESHOLD pixels darker than threshold are black, OTSU picks the
+	threshold from the histogram of the surface and DITHER uses an ordered
+	dither for gray areas. Only the green channel is used, which is close
+	enough to the brightness for printed documents.
+
+	If the surface is a band of a larger sheet, y is the row of the sheet it
+	starts at. Bands should be converted with the OTSU threshold of the
+	whole sheet, see get_histogram and otsu_threshold."""
+	if mode == OTSU:
+		threshold = otsu_threshold(get_histogram(surface), threshold)
+
+	if numpy is not None:
+		return _numpy_rows(surface, mode, threshold, y)
+	else:
+		return _string_rows(surface, mode, threshold, y)
@@ -315,15 +315,8 @@ class Box(GooCanvas.CanvasItemSimple, GooCanvas.CanvasItem):
 
 		cr.save()
 
-		x_offset = self.x * scale
-		y_offset = self.y * scale
-		x_offset = x_offset - math.floor(x_offset)
-		y_offset = y_offset - math.floor(y_offset)
-		x_offset = -x_offset / scale
-		y_offset = -y_offset / scale
-
 		rscale = scale * self._box.dscale
-		result = self._canvas._model.get_rendered_box_or_queue(self._box, rscale, x_offset, y_offset, cr.get_target())
+		result = self._canvas._model.get_rendered_box_or_queue(self._box, rscale, cr.get_target())
 		if result is None:
 			cr.translate(self.x + self.width / 2.0, self.y + self.height / 2.0)
 			cr.set_source_rgb(0.4, 0.4, 0.4)
@@ -342,13 +335,17 @@ class Box(GooCanvas.CanvasItemSimple, GooCanvas.CanvasItem):
 		else:
 			image = result[0]
 			iscale = result[1]
-			x_offset = result[2]
-			y_offset = result[3]
-			cr.translate(self.x, self.y)
-			cr.rectangle(0, 0, self.width, self.height)
-			cr.translate(x_offset, y_offset)
+
+			# The render does not depend on the position of the box, it is
+			# shifted by less than half a pixel so that it is on the pixel grid.
+			x_offset = (round(self.x * scale) - self.x * scale) / scale
+			y_offset = (round(self.y * scale) - self.y * scale) / scale
+			margin = model.BOX_RENDER_MARGIN
+
+			cr.translate(self.x + x_offset, self.y + y_offset)
+			cr.rectangle(-x_offset, -y_offset, self.width, self.height)
 			cr.scale(1 / iscale * self._box.dscale, 1 / iscale * self._box.dscale)
-			cr.set_source_surface(image)
+			cr.set_source_surface(image, -margin, -margin)
 			cr.fill()
 
 		cr.restore()
@@ -465,6 +462,7 @@ class BuildView(GooCanvas.Canvas):
 		self._focus_list = []
 
 		self.connect('draw', self.update_page_label)
+		self.connect('draw', self._update_visible_boxes)
 
 	def _add_item_to_focus_group(self, item):
 		if item is not self._focused_item and item not in self._focus_list:
@@ -652,6 +650,16 @@ class BuildView(GooCanvas.Canvas):
 		dbox.remove()
 		self._update_pages()
 
+	def _update_visible_boxes(self, *args):
+		if self._model is None:
+			return
+
+		bounds = self.get_visible_bounds()
+		boxes = [box for box, item in self._boxes.iteritems()
+		         if item.x <= bounds.x2 and item.x + item.width >= bounds.x1 and
+		            item.y <= bounds.y2 and item.y + item.height >= bounds.y1]
+		self._model.set_visible_boxes(boxes)
+
 	def update_page_label(self, *args):
 		pages = len(self._pages)
 		ypos = self.get_vadjustment().get_value()
@@ -714,7 +722,16 @@ class BuildView(GooCanvas.Canvas):
 		if scale <= 0.2 and zoom < 1:
 			return True
 		
-		scale *= zoom
+		# Step along the scale ladder of the model so that renders can be
+		# reused when zooming back
+		level = model.get_scale_level(scale)
+		if zoom > 1:
+			level += 1
+		else:
+			level -= 1
+		new_scale = model.get_level_scale(level)
+		zoom = new_scale / scale
+		scale = new_scale
 		self.set_scale(scale)
 
 		if self.get_hadjustment() and self.get_vadjustment():
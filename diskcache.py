@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# PDFCutter
+#
+# Copyright (C) 2009, Benjamin Berg <benjamin@sipsolutions.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import errno
+import hashlib
+import tempfile
+import shmsurface
+
+_MAGIC = 'PDFCutter render'
+
+class DiskCache(object):
+	"""A cache for rendered surfaces on disk.
+
+	Entries are stored in one file each, named after the hash of their key.
+	If the cache grows larger than max_size bytes, the least recently used
+	files are removed. The cache may be used by several processes at the same
+	time, so every process keeps its own estimate of the size and rescans the
+	directory once that gets too large."""
+
+	def __init__(self, directory, max_size=512 * 1024 * 1024):
+		self.directory = directory
+		self.max_size = max_size
+		self._size = None
+
+		try:
+			os.makedirs(directory)
+		except OSError, e:
+			if e.errno != errno.EEXIST:
+				raise
+
+	def _get_path(self, key):
+		return os.path.join(self.directory, hashlib.sha1(key).hexdigest())
+
+	def load(self, key):
+		"""Returns a shmsurface handle for the cached surface, or None."""
+		path = self._get_path(key)
+		try:
+			f = open(path, 'rb')
+		except IOError:
+			return None
+
+		try:
+			header = f.readline().split()
+			if ' '.join(header[:2]) != _MAGIC:
+				return None
+			format, width, height, stride = [int(i) for i in header[2:]]
+
+			data = f.read()
+			if len(data) != stride * height:
+				return None
+		finally:
+			f.close()
+
+		surface, handle = shmsurface.create(format, width, height)
+		if surface.get_stride() != stride:
+			shmsurface.discard(handle)
+			return None
+
+		d = surface.get_data()
+		d[:] = data
+		surface.mark_dirty()
+		surface.flush()
+
+		# Mark as recently used
+		try:
+			os.utime(path, None)
+		except OSError:
+			pass
+
+		return handle
+
+	def store(self, key, handle, source=None):
+		"""Store the surface for the shmsurface handle, the handle stays
+		valid. source is an open file with the data of the handle, which is
+		closed. It can be opened before the handle is passed on, as it stays
+		readable after the handle was opened elsewhere."""
+		shm_path, format, width, height, stride = handle
+
+		if source is None:
+			source = open(shm_path, 'rb')
+		try:
+			data = source.read()
+		finally:
+			source.close()
+
+		# Write to a temporary file first, others may read at the same time
+		fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=self.directory)
+		try:
+			f = os.fdopen(fd, 'wb')
+			try:
+				f.write('%s %i %i %i %i\n' % (_MAGIC, format, width, height, stride))
+				f.write(data)
+			finally:
+				f.close()
+			os.rename(tmp_path, self._get_path(key))
+		except EnvironmentError:
+			# Disk full or similar, just do not cache
+			try:
+				os.unlink(tmp_path)
+			except OSError:
+				pass
+			return
+
+		if self._size is None:
+			self._size = self._scan()[1]
+		else:
+			self._size += len(data)
+
+		if self._size > self.max_size:
+			self._evict()
+
+	def _scan(self):
+		files = []
+		size = 0
+		for name in os.listdir(self.directory):
+			path = os.path.join(self.directory, name)
+			try:
+				st = os.stat(path)
+			except OSError:
+				# Removed by someone else
+				continue
+			files.append((st.st_mtime, st.st_size, path))
+			size += st.st_size
+		return files, size
+
+	def _evict(self):
+		files, size = self._scan()
+		files.sort()
+
+		# Remove a bit more, so that this does not happen for every store
+		limit = self.max_size * 0.9
+		for mtime, file_size, path in files:
+			if size <= limit:
+				break
+			try:
+				os.unlink(path)
+			except OSError:
+				pass
+			size -= file_size
+
+		self._size = size
@@ -13,7 +13,14 @@ class GProcess(multiprocessing.Process):
         multiprocessing.Process.start(self, *args, **kwargs)
 
         # And register the pipe in the mainloop of the main process
-        GLib.io_add_watch(self.pipe_r, GLib.IO_IN, self._child_event)
+        self._watch_id = GLib.io_add_watch(self.pipe_r, GLib.IO_IN, self._child_event)
+
+    def close_pipe(self):
+        """Stop watching the wakeup pipe and close it, e.g. once the child
+        has died."""
+        GLib.source_remove(self._watch_id)
+        os.close(self.pipe_r)
+        os.close(self.pipe_w)
 
     def __init__(self, *args, **kwargs):
         if 'childcb' in kwargs:
@@ -572,3 +572,84 @@ class TimedLRU(LRU):
         except TypeError:
             return self.get_func(*args, **kwargs)
 
+
+
+class WeightedLRU(LRU):
+    """This weighted LRU is the same as the normal LRU, however instead of
+    limiting the number of items, it limits the sum of their weights.
+    The weight of an item is calculated by calling weight_func with the value
+    whenever it is set. If weight_func returns None, the item keeps the weight
+    it had before (or 0 if it is new), which is handy if a value is replaced
+    by an equivalent one.
+    The least recently used items are discarted until the total weight is
+    below max_weight again. The item that was set last is never discarted,
+    even if it is heavier then max_weight on its own.
+    """
+    
+    __slots__ = ['_weight_func', '_max_weight', '_weight', 'get_weight']
+    
+    
+    def __init__(self, max_weight, weight_func, pairs=[]):
+        """Create a weighted LRU, the function wrapping mode of the LRU is not
+        supported.
+        """
+        self._weight_func = weight_func
+        self._max_weight = max_weight
+        self._weight = 0
+        
+        # There is no limit on the number of items
+        LRU.__init__(self, None, pairs)
+    
+    
+    def __setitem__(self, key, value):
+        items = self._items
+        start = self._start
+        weight = self._weight_func(value)
+        
+        if not key in items:
+            if weight is None:
+                weight = 0
+            self._length += 1
+            
+            # Create correct new item, 4 is the weight:
+            item = [key, value, start, start[3], weight]
+            items[key] = item
+        else:
+            item = items[key]
+            
+            # Set the item vor dictionary like mode in case its changed:
+            item[1] = value
+            
+            # Unlink the item:
+            item[2][3] = item[3]
+            item[3][2] = item[2]
+            
+            # Modify item in place (saves another fiew cycles):
+            item[2] = start
+            item[3] = start[3]
+            
+            if weight is None:
+                weight = item[4]
+            self._weight -= item[4]
+            item[4] = weight
+        
+        self._weight += weight
+        
+        # Modify start and old first value:
+        start[3][2] = item
+        start[3] = item
+        
+        # Discard the oldest items, but never the new one:
+        while self._weight > self._max_weight and self._end[2] is not item:
+            self._delete(self._end[2])
+    
+    
+    def _delete(self, item):
+        LRU._delete(self, item)
+        self._weight -= item[4]
+    
+    
+    def get_weight(self):
+        """Return the total weight of all items.
+        """
+        return self._weight
@@ -152,11 +152,7 @@ class Canvas(Gtk.DrawingArea, Gtk.Scrollable):
         cr.set_source_rgb(1,1,1)
         cr.paint()
 
-        bounds = Bounds()
-        bounds.x1 = self.hadj.props.value / self._scale
-        bounds.y1 = self.vadj.props.value / self._scale
-        bounds.x2 = bounds.x1 + self.hadj.props.page_size / self._scale
-        bounds.y2 = bounds.y1 + self.vadj.props.page_size / self._scale
+        bounds = self.get_visible_bounds()
 
         cr.scale(self._scale, self._scale)
         cr.translate(-bounds.x1, -bounds.y1)
@@ -166,6 +162,14 @@ class Canvas(Gtk.DrawingArea, Gtk.Scrollable):
             c.do_paint(cr, bounds, self._scale)
             cr.restore()
 
+    def get_visible_bounds(self):
+        bounds = Bounds()
+        bounds.x1 = self.hadj.props.value / self._scale
+        bounds.y1 = self.vadj.props.value / self._scale
+        bounds.x2 = bounds.x1 + self.hadj.props.page_size / self._scale
+        bounds.y2 = bounds.y1 + self.vadj.props.page_size / self._scale
+        return bounds
+
     def viewpixel_to_coordinate(self, x, y):
         x = self.bounds.x1 + (x + self.hadj.props.value) / self._scale
         y = self.bounds.y1 + (y + self.vadj.props.value) / self._scale
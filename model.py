@@ -23,12 +23,16 @@ from gi.repository import Pango
 from gi.repository import PangoCairo
 from gi.repository import GObject
 from gi.repository import Poppler
-import multiprocessing
-from gprocess import GProcess
+from renderservice import RenderService, TILE_SIZE, BOX_RENDER_MARGIN
 import os
 import math
-import tempfile
-from lru import LRU
+import time
+import traceback
+import multiprocessing
+from lru import WeightedLRU
+import shmsurface
+import tiff
+import bilevel
 
 def relpath(path, start=os.path.curdir):
 	"""Return a relative version of a path"""
@@ -58,11 +62,320 @@ def relpath(path, start=os.path.curdir):
 		return os.path.curdir
 	return os.path.join(*rel_list)
 
+# Renders are only done at scales on a ladder with this many levels for every
+# doubling of the scale (this matches the zoom steps of the views). Level 0 is
+# a scale of 1.0.
+SCALE_LEVELS_PER_OCTAVE = 3
+# While rendering, a cached render up to this many levels away may be shown.
+MAX_LEVEL_DISTANCE = 6
+
+def get_scale_level(scale):
+	"""Returns the level of the ladder scale that is closest to scale."""
+	return int(round(math.log(scale, 2) * SCALE_LEVELS_PER_OCTAVE))
+
+def get_level_scale(level):
+	"""Returns the scale for a level on the ladder."""
+	return 2.0 ** (float(level) / SCALE_LEVELS_PER_OCTAVE)
+
+def quantize_scale(scale):
+	"""Snaps scale to the closest scale on the ladder."""
+	return get_level_scale(get_scale_level(scale))
+
 PADDING = 10*72/25.4
 TOP_PADDING = 17*72/25.4
 
 HEADER_FONT = 'Bitstream Vera Serif 10'
 
+# Resolution of the TIF export, and how the sheets are converted to black
+# and white (see bilevel.convert_rows)
+TIF_DPI = 300
+TIF_MODE = bilevel.THRESHOLD
+# Sheets are rasterized in bands of this many rows, so that only a small
+# part of the sheet is held in memory at a time
+TIF_BAND_HEIGHT = 256
+
+# Exports run in worker processes, which are checked on this often (in ms)
+EXPORT_PROGRESS_INTERVAL = 100
+
+def _draw_header(cr, header_text):
+	font = Pango.FontDescription(HEADER_FONT)
+	font.set_weight(Pango.Weight.BOLD)
+	layout = PangoCairo.create_layout(cr)
+	layout.set_text(header_text, len(header_text))
+	layout.set_font_description(font)
+	cr.move_to(PADDING, PADDING)
+	cr.set_source_rgb(0, 0, 0)
+	PangoCairo.show_layout(cr, layout)
+
+def _draw_box(cr, document, box):
+	# box is a tuple of (spage, sx, sy, width, height, dx, dy, dscale)
+	spage, sx, sy, width, height, dx, dy, dscale = box
+	cr.save()
+	cr.translate(+dx, +dy)
+	cr.scale(dscale, dscale)
+	cr.rectangle(0, 0, width, height)
+	cr.clip()
+	cr.translate(-sx, -sy)
+	document.get_page(spage).render_for_printing(cr)
+	cr.restore()
+
+def _draw_sheet(cr, document, header_text, boxes):
+	for box in boxes:
+		_draw_box(cr, document, box)
+
+	_draw_header(cr, header_text)
+
+# The documents opened by the export processes
+_export_documents = {}
+
+def _iter_tif_bands(recording, width_px, height_px):
+	# Replays the recorded sheet into one band of the raster after the other
+	for y in xrange(0, height_px, TIF_BAND_HEIGHT):
+		band = cairo.ImageSurface(cairo.FORMAT_RGB24, width_px, min(TIF_BAND_HEIGHT, height_px - y))
+		cr = cairo.Context(band)
+		cr.set_source_rgb(1, 1, 1)
+		cr.paint()
+		cr.translate(0, -y)
+		cr.scale(TIF_DPI / 72.0, TIF_DPI / 72.0)
+		cr.set_source_surface(recording, 0, 0)
+		cr.paint()
+		band.flush()
+		yield y, band
+
+def _export_tif_sheet(task):
+	# This function runs in a separate process!
+	# Returns the size in pixels and the Group 4 encoded sheet
+	pdffile, width, height, header_text, boxes, mode = task
+
+	if pdffile not in _export_documents:
+		_export_documents[pdffile] = Poppler.Document.new_from_file('file://' + pdffile, None)
+	document = _export_documents[pdffile]
+
+	width_px = int(width / 72.0 * TIF_DPI)
+	height_px = int(height / 72.0 * TIF_DPI)
+
+	# The drawing operations are recorded once, and then rasterized band by
+	# band instead of into a surface for the whole sheet
+	recording = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA, (0, 0, width, height))
+	cr = cairo.Context(recording)
+	_draw_sheet(cr, document, header_text, boxes)
+	del cr
+
+	threshold = 128
+	if mode == bilevel.OTSU:
+		# The threshold depends on the whole sheet, so it is rasterized twice
+		histogram = [0] * 256
+		for y, band in _iter_tif_bands(recording, width_px, height_px):
+			histogram = map(sum, zip(histogram, bilevel.get_histogram(band)))
+		threshold = bilevel.otsu_threshold(histogram, threshold)
+		mode = bilevel.THRESHOLD
+
+	# We need to use Group4, or some programs cannot handle the file!
+	encoder = tiff.G4Encoder(width_px)
+	data = []
+	for y, band in _iter_tif_bands(recording, width_px, height_px):
+		for row in bilevel.convert_rows(band, mode, threshold, y):
+			encoder.add_row(row)
+		data.append(encoder.take_data())
+	data.append(encoder.finish())
+
+	return width_px, height_px, data
+
+class ExportJob(object):
+	"""An export of a snapshot of the model, done by worker processes.
+
+	func(job) is a generator that starts the processes and yields while it
+	waits for them, it reports its progress with set_progress. It is run
+	from the main loop, so that no process is forked while another thread
+	holds a lock of GTK, cairo or poppler.
+
+	progress_cb(pos, count, *args) is called at most every
+	EXPORT_PROGRESS_INTERVAL ms, and with pos == count once the export is
+	done. If it failed, error is set to the traceback by then. A cancelled
+	export does not report anything any more."""
+
+	def __init__(self, func, progress_cb, args):
+		self.error = None
+		self._iterator = func(self)
+		self._progress_cb = progress_cb
+		self._args = args
+		self._cancelled = False
+		self._done = False
+		self._progress = (0, 1)
+		self._reported = None
+
+	def start(self):
+		"""Run the export in the background."""
+		GLib.timeout_add(EXPORT_PROGRESS_INTERVAL, self._step)
+
+	def run(self):
+		"""Run the export, blocks until it is done. The progress is still
+		reported in the main loop."""
+		while self._next():
+			time.sleep(EXPORT_PROGRESS_INTERVAL / 1000.0)
+		GLib.idle_add(self._report)
+
+	def cancel(self):
+		"""Stop the worker processes, the partial file is removed."""
+		if self._done:
+			return
+		self._cancelled = True
+		self._done = True
+		self._iterator.close()
+
+	def set_progress(self, pos, count):
+		self._progress = (pos, count)
+
+	def _next(self):
+		# Returns whether the export is still running
+		try:
+			self._iterator.next()
+			return True
+		except StopIteration:
+			pass
+		except Exception:
+			self.error = traceback.format_exc()
+			sys.stderr.write(self.error)
+		self._done = True
+		return False
+
+	def _step(self):
+		if self._cancelled:
+			return False
+
+		self._next()
+		self._report()
+		return not self._done
+
+	def _report(self):
+		pos, count = self._progress
+		if self._done:
+			pos = count
+		elif pos == count:
+			# Only the end of the export closes the progress dialog
+			pos = count - 1
+
+		if (pos, count) != self._reported:
+			self._reported = (pos, count)
+			self._progress_cb(pos, count, *self._args)
+
+		return False
+
+def _remove_partial_file(filename):
+	try:
+		os.unlink(filename)
+	except OSError:
+		pass
+
+def _export_pdf_process(progress, conn, pdffile, width, height, header_text, sheets, filename):
+	# This function runs in a separate process!
+	# Sends None once the file is written, or the traceback if it failed
+	try:
+		document = Poppler.Document.new_from_file('file://' + pdffile, None)
+		surface = cairo.PDFSurface(filename, width, height)
+		# Fallback resolution
+		surface.set_fallback_resolution(300, 300)
+		cr = cairo.Context(surface)
+
+		for i, boxes in enumerate(sheets):
+			if i > 0:
+				cr.show_page()
+			for box in boxes:
+				_draw_box(cr, document, box)
+				progress.value += 1
+			_draw_header(cr, header_text)
+
+		surface.finish()
+		conn.send(None)
+	except Exception:
+		conn.send(traceback.format_exc())
+
+def _export_pdf(job, pdffile, width, height, header_text, sheets, filename):
+	count = max(sum(len(boxes) for boxes in sheets), 1)
+
+	# A single process draws the whole file and counts the boxes it is done with
+	progress = multiprocessing.Value('i', 0)
+	conn_p, conn_c = multiprocessing.Pipe(False)
+	process = multiprocessing.Process(target=_export_pdf_process,
+	                                  args=(progress, conn_c, pdffile, width, height, header_text, sheets, filename))
+	process.start()
+	finished = False
+	try:
+		while not conn_p.poll():
+			if not process.is_alive() and not conn_p.poll():
+				raise RuntimeError("The export process died")
+			job.set_progress(progress.value, count)
+			yield
+
+		error = conn_p.recv()
+		if error is not None:
+			raise RuntimeError(error)
+		job.set_progress(count, count)
+		finished = True
+	finally:
+		if process.is_alive():
+			process.terminate()
+		process.join()
+		conn_p.close()
+		conn_c.close()
+		if not finished:
+			_remove_partial_file(filename)
+
+def _export_tif(job, pdffile, width, height, header_text, sheets, filename):
+	count = len(sheets)
+
+	# The pages are rendered and encoded in parallel, one process per
+	# core, and written to the file in order as they are done
+	writer = tiff.TIFFWriter(filename, TIF_DPI)
+	pool = multiprocessing.Pool()
+	finished = False
+	try:
+		results = []
+		for boxes in sheets:
+			task = (pdffile, width, height, header_text, boxes, TIF_MODE)
+			results.append(pool.apply_async(_export_tif_sheet, (task,)))
+		pool.close()
+
+		for i, result in enumerate(results):
+			while not result.ready():
+				yield
+			width_px, height_px, data = result.get()
+			writer.add_page(width_px, height_px, data)
+			job.set_progress(i + 1, count)
+		finished = True
+	finally:
+		pool.terminate()
+		pool.join()
+		writer.close()
+		if not finished:
+			_remove_partial_file(filename)
+
+# Pages are rendered as a whole only up to this size (in pixels), at higher
+# zoom levels the visible parts are rendered as tiles of TILE_SIZE pixels.
+MAX_PAGE_RENDER_SIZE = 2048
+
+# Memory used for cached renders (in bytes), and how it is shared
+MEMORY_BUDGET = 256 * 1024 * 1024
+PAGE_CACHE_SHARE = 0.5
+TILE_CACHE_SHARE = 0.25
+BOX_CACHE_SHARE = 0.25
+
+# Scale of the quick preview that is shown until the real render is done
+PREVIEW_SCALE = 0.25
+
+# Boxes and pages that take too long to render are rendered at half the
+# scale instead, down to this scale
+MIN_FALLBACK_SCALE = 0.1
+
+# Renders are copied to the X server in an idle handler, which stops after
+# this many seconds so that the next frame is not delayed
+UPLOAD_TIME_BUDGET = 0.004
+
+# Priorities of the render jobs, lower values are rendered first
+PRIORITY_PREVIEW = 0
+PRIORITY_VISIBLE = 1
+PRIORITY_PREFETCH = 2
+
 class Box(GObject.GObject):
 	__gtype_name__ = 'PDFCutterBox'
 	__gsignals__ = {
@@ -173,26 +486,48 @@ class Model(GObject.GObject):
 		'header-text-changed': (GObject.SIGNAL_RUN_FIRST, GObject.TYPE_NONE, ())
 	}
 
-	def __init__(self, pdffile=None, loadfile=None):
+	def __init__(self, pdffile=None, loadfile=None, render_service=None, memory_budget=MEMORY_BUDGET):
 		GObject.GObject.__init__(self)
 
 		self.pdffile = pdffile
 		self.loadfile = loadfile
 		self.header_text = "HEADER TEXT"
 		self._boxes = []
-		self._rendered_boxes = LRU(200)
-		self._rendered_pages = LRU(5)
-
-		self._box_render_process = GProcess(target=self._box_render_proc, childcb=self._box_rendered_wakeup)
-		self._page_render_process = GProcess(target=self._page_render_proc, childcb=self._page_rendered_wakeup)
-
-		# These are only for the main process, to prevent an item from being
-		# queued twice.
-		self._box_render_queue = []
-		self._page_render_queue = []
-
-		self._box_render_pipe_p, self._box_render_pipe_c = multiprocessing.Pipe()
-		self._page_render_pipe_p, self._page_render_pipe_c = multiprocessing.Pipe()
+		# Box renders are shared by all boxes that cut out the same area. For
+		# every such geometry the list of boxes using it is kept, and the
+		# renders are dropped once no box references them anymore.
+		self._box_geometries = {}
+		self._geometry_boxes = {}
+		# The caches are limited by the memory the surfaces need
+		self._rendered_boxes = WeightedLRU(memory_budget * BOX_CACHE_SHARE, self._get_entry_size)
+		self._rendered_pages = WeightedLRU(memory_budget * PAGE_CACHE_SHARE, self._get_entry_size)
+		self._rendered_tiles = WeightedLRU(memory_budget * TILE_CACHE_SHARE, self._get_entry_size)
+
+		# The render workers are usually shared with other models, if none
+		# are given the model has its own. They are started once the first
+		# render is queued, so a model that is only exported needs none.
+		self._own_render_service = render_service is None
+		if render_service is None:
+			render_service = RenderService()
+		self._render_service = render_service
+
+		# Jobs that failed, so that they are not queued again and again.
+		self._failed_renders = set()
+
+		# What the views currently show, queued renders for anything else
+		# are cancelled.
+		self._visible_pages = set()
+		self._visible_boxes = set()
+		# The scale that tiles are currently requested at, per page
+		self._tile_scales = {}
+
+		# Cache entries that should be copied to the X server, as
+		# (cache, key, similar_surface, content)
+		self._pending_uploads = []
+		self._pending_upload_keys = set()
+		self._upload_idle_id = None
+
+		self.connect("box-changed", self._box_changed_cb)
 
 		if loadfile:
 			self._load_from_file()
@@ -200,229 +535,238 @@ class Model(GObject.GObject):
 		self.document = \
 			Poppler.Document.new_from_file('file://' + self.pdffile, None)
 
-		self._box_render_process.start()
-		self._page_render_process.start()
+		self._box_render_pool, self._page_render_pool = \
+			render_service.attach(self.pdffile, self._box_rendered, self._page_rendered,
+			                      self._render_failed, self._render_timed_out)
 
 	def set_header_text(self, value):
 		self.header_text = value
 		self.emit('header-text-changed')
 
-	def get_rendered_box_or_queue (self, box, scale, x_offset, y_offset, similar_surface):
-		try:
-			# Try to retrieve a preprendered box
-			result, _scale, page, x, y, width, height, dscale, _x_offset, _y_offset, uploaded = self._rendered_boxes[box]
+	def set_visible_pages(self, pages):
+		"""Set the pages that are on screen. Renders that are queued for
+		other pages are cancelled."""
+		pages = set(pages)
+		if pages == self._visible_pages:
+			return
 
-			# Check whether surface can and is not uploaded to the X server
-			if similar_surface and not uploaded:
-				iwidth, iheight = result.get_width(), result.get_height()
-				surf = similar_surface.create_similar(cairo.CONTENT_COLOR_ALPHA, iwidth, iheight)
-				cr = cairo.Context(surf)
-				cr.set_operator(cairo.OPERATOR_SOURCE)
-				cr.set_source_surface(result, 0, 0)
-				cr.paint()
-
-				result = surf
-				self._rendered_boxes[box] = (result, _scale, page, x, y, width, height, dscale, _x_offset, _y_offset, True)
-
-			if scale != _scale or page != box.spage or x != box.sx or \
-			   y != box.sy or width != box.width or height != box.height or\
-			   x_offset != _x_offset or y_offset != _y_offset:
-				# Queue a render at the correct scale
-				self._queue_box_render_at_scale(box, scale, x_offset, y_offset)
-
-			if page != box.spage or x != box.sx or \
-			   y != box.sy or width != box.width or height != box.height:
-				result = None
-
-			if result is not None:
-				return result, _scale, _x_offset, _y_offset
-		except KeyError:
-			self._queue_box_render_at_scale(box, scale, x_offset, y_offset)
+		self._visible_pages = pages
+		self._page_render_pool.cancel_matching(lambda key: key[1] not in pages)
+
+	def set_visible_boxes(self, boxes):
+		"""Set the boxes that are on screen. Renders that are queued for
+		other boxes are cancelled."""
+		geometries = set(self._get_box_geometry(box) for box in boxes)
+		if geometries == self._visible_boxes:
+			return
+
+		self._visible_boxes = geometries
+		self._box_render_pool.cancel_matching(lambda key: key[1] not in geometries)
+
+	def _find_cached_level(self, cache, item, level):
+		# Returns the cached level closest to level for item, preferring the
+		# higher resolution. The cache needs to be keyed by (item, level).
+		for distance in xrange(MAX_LEVEL_DISTANCE + 1):
+			for l in (level + distance, level - distance):
+				if (item, l) in cache:
+					return l
+		return None
+
+	def get_rendered_box_or_queue (self, box, scale, similar_surface):
+		"""Returns the surface and its scale. The surface starts
+		BOX_RENDER_MARGIN pixels to the left and above the box."""
+		level = get_scale_level(scale)
+		scale = get_level_scale(level)
+
+		geometry = self._get_box_geometry(box)
+
+		# Try to retrieve a preprendered box, at a different scale if needed
+		cached_level = self._find_cached_level(self._rendered_boxes, geometry, level)
+		if cached_level is None:
+			self._queue_box_render_at_scale(geometry, scale, preview=True)
+			return None
+
+		key = (geometry, cached_level)
+		result, _scale, page, x, y, width, height, uploaded = self._rendered_boxes[key]
+
+		# Check whether surface can and is not uploaded to the X server
+		if similar_surface and not uploaded:
+			self._queue_upload(self._rendered_boxes, key, similar_surface, cairo.CONTENT_COLOR_ALPHA)
+
+		if cached_level != level:
+			# Queue a render at the correct scale
+			self._queue_box_render_at_scale(geometry, scale)
+
+		return result, _scale
 
 	def get_rendered_page_or_queue (self, page, scale, x_offset, y_offset, similar_surface):
-		try:
-			result, _page, _scale, _x_offset, _y_offset, uploaded = self._rendered_pages[page]
+		level = get_scale_level(scale)
+		scale = get_level_scale(level)
 
-			# Check whether surface can and is not uploaded to the X server
-			if similar_surface and not uploaded:
-				iwidth, iheight = result.get_width(), result.get_height()
-				surf = similar_surface.create_similar(cairo.CONTENT_COLOR, iwidth, iheight)
-				cr = cairo.Context(surf)
-				cr.set_operator(cairo.OPERATOR_SOURCE)
-				cr.set_source_surface(result, 0, 0)
-				cr.paint()
+		# Show the closest zoom level that is cached until the render is done
+		cached_level = self._find_cached_level(self._rendered_pages, page, level)
+		if cached_level is None:
+			self._queue_page_render_at_scale(page, scale, x_offset, y_offset, preview=True)
+			return None
 
-				result = surf
-				self._rendered_pages[page] = (result, _page, _scale, _x_offset, _y_offset, True)
+		key = (page, cached_level)
+		result, _page, _scale, _x_offset, _y_offset, uploaded = self._rendered_pages[key]
 
-			if scale != _scale or x_offset != _x_offset or y_offset != _y_offset:
-				# Queue a render at the correct scale
-				self._queue_page_render_at_scale(page, scale, x_offset, y_offset)
+		# Check whether surface can and is not uploaded to the X server
+		if similar_surface and not uploaded:
+			self._queue_upload(self._rendered_pages, key, similar_surface, cairo.CONTENT_COLOR)
 
-			return result, _scale, _x_offset, _y_offset
-		except KeyError:
+		if cached_level != level or x_offset != _x_offset or y_offset != _y_offset:
+			# Queue a render at the correct scale
 			self._queue_page_render_at_scale(page, scale, x_offset, y_offset)
+
+		return result, _scale, _x_offset, _y_offset
+
+	def prefetch_page(self, page, scale, x_offset, y_offset):
+		"""Render the page in the background if it is not cached yet, e.g.
+		because it is about to be scrolled into view."""
+		level = get_scale_level(scale)
+		scale = get_level_scale(level)
+
+		key = (page, level)
+		if key in self._rendered_pages:
+			result, _page, _scale, _x_offset, _y_offset, uploaded = self._rendered_pages.dict_get(key)
+			if x_offset == _x_offset and y_offset == _y_offset:
+				return
+
+		job = ('page', (page, scale, x_offset, y_offset))
+		self._submit_render(self._page_render_pool, ('page', page), job, PRIORITY_PREFETCH)
+
+	def get_page_render_time(self):
+		"""Returns the average time in seconds until a page is rendered when
+		all page workers are busy, or None if this is not known yet."""
+		average = self._page_render_pool.get_average_time()
+		if average is None:
 			return None
+		return average / self._page_render_pool.get_worker_count()
+
+	def get_page_render_scale(self, page, scale):
+		"""Returns the scale at which the whole page is rendered. If this is
+		smaller than scale, the page needs to be painted using tiles."""
+		width, height = self.document.get_page(page).get_size()
+		max_scale = MAX_PAGE_RENDER_SIZE / max(width, height)
+		max_level = int(math.floor(math.log(max_scale, 2) * SCALE_LEVELS_PER_OCTAVE))
+		return min(quantize_scale(scale), get_level_scale(max_level))
+
+	def get_rendered_tile_or_queue (self, page, scale, tile_x, tile_y, x_offset, y_offset, similar_surface):
+		"""Tiles are rendered at the closest scale on the ladder, which is
+		returned together with the tile."""
+		scale = quantize_scale(scale)
+		key = (page, scale, tile_x, tile_y)
+		try:
+			result, _x_offset, _y_offset, uploaded = self._rendered_tiles[key]
 
-	def _emit_progress_cb(self, progress_cb, pos, count, *args):
-		progress_cb(pos, count, *args)
+			# Check whether surface can and is not uploaded to the X server
+			if similar_surface and not uploaded:
+				self._queue_upload(self._rendered_tiles, key, similar_surface, cairo.CONTENT_COLOR)
 
-	def _real_emit_tif(self, filename, progress_cb, *pbargs):
-		tmpdir = tempfile.mkdtemp()
-		
-		def write_tif(surface, tmpdir, page):
-			png = os.path.join(tmpdir, "%i.png" % page)
-			tif = os.path.join(tmpdir, "%i.tif" % page)
-			surface.write_to_png(png)
-			# We need to use Group4, or some programs cannot handle the file!
-			# We also need to force a resolution of 300 dpi on the tiff (the pngs are wrong)
-			os.spawnv(os.P_WAIT, '/usr/bin/convert', ['convert', png, '-units', 'PixelsPerInch', '-density', '300', '-monochrome', '-compress', 'Group4', tif])
-			os.unlink(png)
+			if x_offset != _x_offset or y_offset != _y_offset:
+				self._queue_tile_render(page, scale, tile_x, tile_y, x_offset, y_offset)
 
-		self.sort_boxes()
-		width, height = self.document.get_page(0).get_size()
-		width_px = int(width / 72.0 * 300)
-		height_px = int(height / 72.0 * 300)
+			return result, scale, _x_offset, _y_offset
+		except KeyError:
+			self._queue_tile_render(page, scale, tile_x, tile_y, x_offset, y_offset)
+			return None
 
-		surface = cairo.ImageSurface(cairo.FORMAT_RGB24, width_px, height_px)
-		cr = cairo.Context(surface)
-		cr.set_source_rgb(1, 1, 1)
-		cr.paint()
-		cr.scale(300.0 / 72.0, 300 / 72.0)
-		font = Pango.FontDescription(HEADER_FONT)
-		font.set_weight(Pango.Weight.BOLD)
-		page = 0
+	def _get_entry_size(self, entry):
+		# The surface is always the first item of a cache entry. Surfaces on
+		# the X server cannot be measured, they keep the size of the image.
+		surface = entry[0]
+		if isinstance(surface, cairo.ImageSurface):
+			return surface.get_stride() * surface.get_height()
+		return None
+
+	def _queue_upload(self, cache, key, similar_surface, content):
+		# The image surface is painted until the upload is done
+		if (id(cache), key) in self._pending_upload_keys:
+			return
 
-		def show_text():
-			layout = PangoCairo.create_layout(cr)
-			layout.set_text(self.header_text, len(self.header_text))
-			layout.set_font_description(font)
-			cr.move_to(PADDING, PADDING)
-			cr.set_source_rgb(0, 0, 0)
-			PangoCairo.show_layout(cr, layout)
+		self._pending_upload_keys.add((id(cache), key))
+		self._pending_uploads.append((cache, key, similar_surface, content))
+		if self._upload_idle_id is None:
+			self._upload_idle_id = GLib.idle_add(self._upload_idle)
 
-		progress = 0
-		GObject.idle_add(self._emit_progress_cb, progress_cb, progress, len(self._boxes), *pbargs)
-		for box in self.iter_boxes():
-			while box.dpage > page:
-				page += 1
-				show_text()
-				write_tif(surface, tmpdir, page)
-				cr.set_source_rgb(1, 1, 1)
-				cr.paint()
-				yield
-			cr.save()
-			cr.translate(+box.dx, +box.dy)
-			cr.scale(box.dscale, box.dscale)
-			cr.rectangle(0, 0, box.width, box.height)
-			cr.clip()
-			cr.translate(-box.sx, -box.sy)
-			self.document.get_page(box.spage).render_for_printing(cr)
-			cr.restore()
-
-			progress += 1
-			GObject.idle_add(self._emit_progress_cb, progress_cb, progress, len(self._boxes)+1, *pbargs)
-			# XXX: Hack to split up the task into chunks using the mainloop
-			yield
+	def _upload_idle(self):
+		start = time.time()
+		while self._pending_uploads:
+			cache, key, similar_surface, content = self._pending_uploads.pop(0)
+			self._pending_upload_keys.discard((id(cache), key))
 
-		page += 1
-		show_text()
-		write_tif(surface, tmpdir, page)
-		
-		input = [ os.path.join(tmpdir, "%i.tif" % i) for i in xrange(1, page+1) ]
+			# The entry may have been dropped or replaced in the meantime
+			if key not in cache:
+				continue
+			entry = cache.dict_get(key)
+			if entry[-1]:
+				continue
 
-		args = [ 'tiffcp' ]
-		args += input
-		args.append(filename)
-		os.spawnv(os.P_WAIT, '/usr/bin/tiffcp', args)
+			# The uploaded flag is always the last item of a cache entry
+			surface = self._upload_surface(entry[0], similar_surface, content)
+			cache.dict_set(key, (surface,) + entry[1:-1] + (True,))
 
-		for file in input:
-			os.unlink(file)
-		os.rmdir(tmpdir)
+			if time.time() - start > UPLOAD_TIME_BUDGET:
+				return True
+
+		self._upload_idle_id = None
+		return False
 
-		# done ...
-		GObject.idle_add(self._emit_progress_cb, progress_cb, len(self._boxes)+1, len(self._boxes)+1, *pbargs)
+	def _upload_surface(self, surface, similar_surface, content):
+		width, height = surface.get_width(), surface.get_height()
+		result = similar_surface.create_similar(content, width, height)
+		cr = cairo.Context(result)
+		cr.set_operator(cairo.OPERATOR_SOURCE)
+		cr.set_source_surface(surface, 0, 0)
+		cr.paint()
 
+		return result
 
-	def _real_emit_pdf(self, filename, progress_cb, *args):
+	def _get_sheets(self):
+		# The boxes of every output page, as needed by _draw_sheet
+		sheets = [[]]
+		for box in self.iter_boxes():
+			while box.dpage >= len(sheets):
+				sheets.append([])
+			sheets[box.dpage].append((box.spage, box.sx, box.sy, box.width, box.height, box.dx, box.dy, box.dscale))
+		return sheets
+
+	def _create_export(self, func, filename, progress_cb, args):
+		# The export works on a copy of the boxes and opens the document
+		# again, so that the project can be edited meanwhile
 		self.sort_boxes()
+		sheets = self._get_sheets()
 		width, height = self.document.get_page(0).get_size()
-		surface = cairo.PDFSurface(filename, width, height)
-		# Fallback resolution
-		surface.set_fallback_resolution(300, 300)
-		cr = cairo.Context(surface)
-		font = Pango.FontDescription(HEADER_FONT)
-		font.set_weight(Pango.Weight.BOLD)
-		page = 0
+		pdffile = self.pdffile
+		header_text = self.header_text
 
-		def show_text():
-			layout = PangoCairo.create_layout(cr)
-			layout.set_text(self.header_text, len(self.header_text))
-			layout.set_font_description(font)
-			cr.move_to(PADDING, PADDING)
-			cr.set_source_rgb(0, 0, 0)
-			PangoCairo.show_layout(cr, layout)
+		def export(job):
+			return func(job, pdffile, width, height, header_text, sheets, filename)
 
-		progress = 0
-		GObject.idle_add(self._emit_progress_cb, progress_cb, progress, len(self._boxes), *args)
-		for box in self.iter_boxes():
-			while box.dpage > page:
-				page += 1
-				show_text()
-				cr.show_page()
-				surface.set_size(width, height)
-			cr.save()
-			cr.translate(+box.dx, +box.dy)
-			cr.scale(box.dscale, box.dscale)
-			cr.rectangle(0, 0, box.width, box.height)
-			cr.clip()
-			cr.translate(-box.sx, -box.sy)
-			self.document.get_page(box.spage).render_for_printing(cr)
-			cr.restore()
-
-			progress += 1
-
-			GObject.idle_add(self._emit_progress_cb, progress_cb, progress, len(self._boxes), *args)
-			# XXX: Hack to split up the task into chunks using the mainloop
-			yield
-
-		show_text()
-		# done ...
-		GObject.idle_add(self._emit_progress_cb, progress_cb, progress, len(self._boxes), *args)
+		return ExportJob(export, progress_cb, args)
 
 	def emit_pdf(self, filename, progress_cb, *args):
 		# XXX: Blocks for now!
-		list(self._real_emit_pdf(filename, progress_cb, *args))
+		self._create_export(_export_pdf, filename, progress_cb, args).run()
 
 	def main_iter_emit_pdf(self, filename, progress_cb, *args):
-		iterator = self._real_emit_pdf(filename, progress_cb, *args)
-
-		def do_next():
-			try:
-				iterator.next()
-			except StopIteration:
-				return False
-
-			return True
-
-		GLib.idle_add(do_next)
+		"""Export to a PDF file in the background, returns the ExportJob."""
+		job = self._create_export(_export_pdf, filename, progress_cb, args)
+		job.start()
+		return job
 
 	def emit_tif(self, filename, progress_cb, *args):
 		# XXX: Blocks for now!
-		list(self._real_emit_tif(filename, progress_cb, *args))
+		self._create_export(_export_tif, filename, progress_cb, args).run()
 
 	def main_iter_emit_tif(self, filename, progress_cb, *args):
-		iterator = self._real_emit_tif(filename, progress_cb, *args)
-
-		def do_next():
-			try:
-				iterator.next()
-			except StopIteration:
-				return False
-
-			return True
-
-		GLib.idle_add(do_next)
+		"""Export to a monochrome TIF file in the background, returns the
+		ExportJob."""
+		job = self._create_export(_export_tif, filename, progress_cb, args)
+		job.start()
+		return job
 
 	def iter_boxes(self):
 		for box in self._boxes:
@@ -459,10 +803,12 @@ class Model(GObject.GObject):
 
 		self._boxes.append(box)
 		box._model = self
+		self._update_box_geometry(box)
 		self.emit("box-added", box)
 
 	def remove_box(self, box):
 		self._boxes.remove(box)
+		self._update_box_geometry(box, removed=True)
 		self.emit("box-removed", box)
 
 	def get_lower_box(self, box):
@@ -551,168 +897,144 @@ class Model(GObject.GObject):
 				raise AssertionError
 			b._model = self
 			self._boxes.append(b)
-
-	def _queue_box_render_at_scale(self, box, scale, x_offset, y_offset):
-		render_info = (scale, box.spage, box.sx, box.sy, box.width, box.height, box.dscale, x_offset, y_offset)
-
-		for b, info in self._box_render_queue:
-			if b == box and info == render_info:
-				return
-
-		# Save in internal list
-		self._box_render_queue.append((box, render_info))
-		# And send item over the wire
-		self._box_render_pipe_p.send(render_info)
-
-	def _queue_page_render_at_scale(self, page, scale, x_offset, y_offset):
-		render_info = (page, scale, x_offset, y_offset)
-
-		if render_info in self._page_render_queue:
+			self._update_box_geometry(b)
+
+	def _get_box_geometry(self, box):
+		return (box.spage, box.sx, box.sy, box.width, box.height)
+
+	def _update_box_geometry(self, box, removed=False):
+		# Moves the reference of the box to its current geometry
+		old_geometry = self._box_geometries.pop(box, None)
+		if old_geometry is not None:
+			boxes = self._geometry_boxes[old_geometry]
+			boxes.remove(box)
+			if not boxes:
+				del self._geometry_boxes[old_geometry]
+				self._drop_box_renders(old_geometry)
+
+		if not removed:
+			geometry = self._get_box_geometry(box)
+			self._box_geometries[box] = geometry
+			self._geometry_boxes.setdefault(geometry, []).append(box)
+
+	def _drop_box_renders(self, geometry):
+		self._box_render_pool.cancel_matching(lambda key: key[1] == geometry)
+		for key in self._rendered_boxes.keys():
+			if key[0] == geometry:
+				del self._rendered_boxes[key]
+
+	def _box_changed_cb(self, model, box):
+		if box in self._box_geometries and self._box_geometries[box] != self._get_box_geometry(box):
+			self._update_box_geometry(box)
+
+	def _submit_render(self, pool, key, job, priority=PRIORITY_VISIBLE):
+		if (key, job) in self._failed_renders:
 			return
 
-		self._page_render_queue.append(render_info)
-		self._page_render_pipe_p.send(render_info)
+		# The pool ignores the request if it is already queued, and replaces
+		# an older request for the same key.
+		pool.submit(key, job, priority)
 
-	def _box_render_proc(self):
-		# This function runs in a separate process!
+	def _queue_box_render_at_scale(self, geometry, scale, preview=False):
+		render_info = (scale,) + geometry
 
-		while True:
-			obj = self._box_render_pipe_c.recv()
-			if obj == 'quit':
-				return
-
-			data = self._pack_surface(self._render_box(obj))
-			# Wake parent first (in case data does not fit into buffer)
-			self._box_render_process.wake_parent()
-			self._box_render_pipe_c.send(data)
-
-	def _page_render_proc(self):
-		# This function runs in a separate process!
-
-		while True:
-			obj = self._page_render_pipe_c.recv()
-			if obj == 'quit':
-				return
+		if preview:
+			# Nothing to show yet, so get a cheap low resolution version first
+			preview_info = (scale * PREVIEW_SCALE,) + geometry
+			self._submit_render(self._box_render_pool, ('preview', geometry), preview_info, PRIORITY_PREVIEW)
 
-			data = self._pack_surface(self._render_page(obj))
-			# Wake parent first (in case data does not fit into buffer)
-			self._page_render_process.wake_parent()
-			self._page_render_pipe_c.send(data)
+		self._submit_render(self._box_render_pool, ('box', geometry), render_info)
 
-	def _recreate_surface(self, surface):
-		f, width, height, stride, data = surface
-		surface = cairo.ImageSurface(f, width, height)
+	def _queue_page_render_at_scale(self, page, scale, x_offset, y_offset, preview=False):
+		if preview:
+			job = ('page', (page, scale * PREVIEW_SCALE, x_offset, y_offset))
+			self._submit_render(self._page_render_pool, ('preview', page), job, PRIORITY_PREVIEW)
 
-		# Has to be the same ... same forked() process ...
-		assert stride == surface.get_stride()
-		d = surface.get_data()
-		d[:] = data
+		job = ('page', (page, scale, x_offset, y_offset))
+		self._submit_render(self._page_render_pool, ('page', page), job)
 
-		surface.mark_dirty()
+	def _queue_tile_render(self, page, scale, tile_x, tile_y, x_offset, y_offset):
+		if self._tile_scales.get(page) != scale:
+			# Tiles for the previous zoom level are not needed anymore
+			self._tile_scales[page] = scale
+			self._page_render_pool.cancel_matching(lambda key: key[0] == 'tile' and key[1] == page and key[2] != scale)
 
-		return surface
+		job = ('tile', (page, scale, tile_x, tile_y, x_offset, y_offset))
+		self._submit_render(self._page_render_pool, ('tile', page, scale, tile_x, tile_y), job)
 
-	b = False
-
-	def _pack_surface(self, surface):
-		surface.flush()
-
-		f = surface.get_format()
-		width = surface.get_width()
-		height = surface.get_height()
-		stride = surface.get_stride()
-		data = surface.get_data()
-		data = str(data)
-
-		return f, width, height, stride, data
+	def _box_rendered(self, key, data, handle):
+		kind, geometry = key
+		# The boxes may have been changed while it was rendered
+		if geometry not in self._geometry_boxes:
+			shmsurface.discard(handle)
+			return
 
-	def _box_rendered_wakeup(self, proc):
-		# XXX: Assumes that nothing ever goes wrong ...
-		box, data = self._box_render_queue.pop(0)
+		surface = shmsurface.open(handle)
 
-		surface_data = self._box_render_pipe_p.recv()
-		surface = self._recreate_surface(surface_data)
+		# Previews are stored at their own level
+		self._rendered_boxes[(geometry, get_scale_level(data[0]))] = (surface,) + data + (False,)
+		GLib.idle_add(self._emit_box_rendered, geometry)
 
-		self._rendered_boxes[box] = (surface,) + data + (False,)
-		GLib.idle_add(self._emit_box_rendered, box)
+	def _page_rendered(self, key, job, handle):
+		kind, data = job
+		page = data[0]
 
-	def _page_rendered_wakeup(self, proc):
-		# XXX: Assumes that nothing ever goes wrong ...
-		data = self._page_render_queue.pop(0)
+		if kind == 'tile':
+			page, scale, tile_x, tile_y, x_offset, y_offset = data
+			self._rendered_tiles[(page, scale, tile_x, tile_y)] = (shmsurface.open(handle), x_offset, y_offset, False)
+		else:
+			# Previews are stored at their own level
+			self._rendered_pages[(page, get_scale_level(data[1]))] = (shmsurface.open(handle),) + data + (False,)
+		GLib.idle_add(self._emit_page_rendered, page)
+
+	def _render_failed(self, key, data, message):
+		sys.stderr.write("%s\n" % message)
+		self._failed_renders.add((key, data))
+
+	def _render_timed_out(self, key, job):
+		# Never try this job again, but queue it at a lower scale
+		self._failed_renders.add((key, job))
+
+		if key[0] == 'box':
+			pool = self._box_render_pool
+			scale = job[0] / 2
+			fallback = (scale,) + job[1:]
+		elif key[0] == 'page':
+			pool = self._page_render_pool
+			page, scale, x_offset, y_offset = job[1]
+			scale = scale / 2
+			fallback = ('page', (page, scale, x_offset, y_offset))
+		else:
+			# Previews and tiles, the view can show something else
+			sys.stderr.write("Rendering took too long, giving up\n")
+			return
 
-		surface_data = self._page_render_pipe_p.recv()
-		surface = self._recreate_surface(surface_data)
+		if scale < MIN_FALLBACK_SCALE:
+			sys.stderr.write("Rendering took too long, giving up\n")
+			return
 
-		self._rendered_pages[data[0]] = (surface,) + data + (False,)
-		GLib.idle_add(self._emit_page_rendered, data[0])
+		sys.stderr.write("Rendering took too long, trying again at a scale of %.2f\n" % scale)
+		self._submit_render(pool, key, fallback, PRIORITY_PREFETCH)
 
-	def _emit_box_rendered(self, box):
-		self.emit("box-rendered", box)
+	def _emit_box_rendered(self, geometry):
+		# Every box with this geometry got a new render
+		for box in list(self._geometry_boxes.get(geometry, [])):
+			self.emit("box-rendered", box)
 		return False
 
 	def _emit_page_rendered(self, page):
 		self.emit("page-rendered", page)
 		return False
 
-	def _render_box(self, data):
-		scale, page_number, x, y, width, height, dscale, x_offset, y_offset = data
-
-		page = self.document.get_page(page_number)
-		scaled_width = width + 1
-		scaled_height = height + 1
-		scaled_width = scaled_width * scale
-		scaled_height = scaled_height * scale
-
-		try:
-			surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, int(math.ceil(scaled_width)), int(math.ceil(scaled_height)))
-		except MemoryError:
-			sys.stderr.write("Cannot render box at this zoom, not enough memory!\n")
-			return None
-
-		cr = cairo.Context(surface)
-		cr.set_source_rgba(0, 0, 0, 0)
-		cr.set_operator(cairo.OPERATOR_SOURCE)
-		cr.paint()
-
-		cr.set_operator(cairo.OPERATOR_OVER)
-		cr.scale(scale, scale)
-		cr.translate(-x - x_offset, -y - y_offset)
-		page.render_for_printing(cr)
-
-		return surface
-
-	def _render_page(self, data):
-		page_number, scale, x_offset, y_offset = data
-
-		page = self.document.get_page(page_number)
-		width, height = page.get_size()
-		width *= scale
-		height *= scale
-		try:
-			surface = cairo.ImageSurface(cairo.FORMAT_RGB24, int(width + 1), int(height + 1))
-		except MemoryError:
-			sys.stderr.write("Cannot render page at this zoom, not enough memory!\n")
-			return None
-
-		cr = cairo.Context(surface)
-		cr.set_source_rgba(1, 1, 1)
-		cr.paint()
-
-		cr.scale(scale, scale)
-		cr.translate(-x_offset, -y_offset)
-		page.render_for_printing(cr)
-
-		return surface
-
 	def shutdown(self):
-		# Let the subprocesses quit.
-		if os.getpid() != self._page_render_process.pid:
-			self._box_render_pipe_p.send('quit')
-			self._page_render_pipe_p.send('quit')
+		if self._upload_idle_id is not None:
+			GLib.source_remove(self._upload_idle_id)
+			self._upload_idle_id = None
 
-			self._box_render_process.join(2)
-			self._page_render_process.join(2)
+		self._box_render_pool.detach()
+		self._page_render_pool.detach()
 
-			self._box_render_process.terminate()
-			self._page_render_process.terminate()
+		# Let the subprocesses quit.
+		if self._own_render_service:
+			self._render_service.shutdown()
 
@@ -29,10 +29,14 @@ import sys
 from pdfview import PDFView
 from buildview import BuildView
 from model import Model
+from diskcache import DiskCache
+from renderservice import RenderService
 
 dir = os.path.dirname(__file__)
 sys.path.append(dir)
 
+DISK_CACHE_SIZE = 512 * 1024 * 1024
+
 
 class MainWindow(object):
 
@@ -40,6 +44,10 @@ class MainWindow(object):
 		self._builder = Gtk.Builder()
 		self._builder.add_from_file(os.path.join(dir, 'main-window.ui'))
 		self._model = None
+		# The render workers are shared by all projects that are opened
+		disk_cache = DiskCache(os.path.join(GLib.get_user_cache_dir(), 'pdfcutter'), DISK_CACHE_SIZE)
+		self._render_service = RenderService(disk_cache=disk_cache)
+		self._render_service.start()
 		
 		self._window = self._builder.get_object("pdfcutter")
 		self._builder.connect_signals(self)
@@ -119,6 +127,20 @@ class MainWindow(object):
 			dialog.response(Gtk.ResponseType.OK)
 			dialog.destroy()
 
+	def export_response(self, dialog, response, job):
+		if response == Gtk.ResponseType.OK:
+			if job.error is not None:
+				msg = Gtk.MessageDialog(parent=self._window, type=Gtk.MessageType.WARNING)
+				msg.add_buttons(Gtk.STOCK_CLOSE, Gtk.ResponseType.CLOSE)
+				msg.set_markup("Error exporting the project!")
+				msg.format_secondary_text(job.error)
+				msg.run()
+				msg.destroy()
+		else:
+			# Cancelled, or the dialog was closed
+			job.cancel()
+			dialog.destroy()
+
 	def export_pdf(self, *args):
 		if self._model is None:
 			return
@@ -140,12 +162,16 @@ class MainWindow(object):
 
 			dialog = Gtk.Dialog(title="Creating PDF %s" % filename,
 			                    parent=self._window,
-			                    flags=Gtk.DialogFlags.MODAL | Gtk.DialogFlags.DESTROY_WITH_PARENT)
+			                    flags=Gtk.DialogFlags.DESTROY_WITH_PARENT)
+			dialog.add_button('gtk-cancel', Gtk.ResponseType.CANCEL)
 			pbar = Gtk.ProgressBar()
 			dialog.get_content_area().add(pbar)
 			pbar.show()
 
-			self._model.main_iter_emit_pdf(filename, self.export_pdf_pb_updater, dialog, pbar)
+			# The export runs in the background on a snapshot of the
+			# project, so it can be edited meanwhile
+			job = self._model.main_iter_emit_pdf(filename, self.export_pdf_pb_updater, dialog, pbar)
+			dialog.connect('response', self.export_response, job)
 
 			# Just return, the dialog will be destroyed by the pb updater
 			dialog.show()
@@ -173,12 +199,14 @@ class MainWindow(object):
 
 			dialog = Gtk.Dialog(title="Creating monochrome TIF File %s" % filename,
 			                    parent=self._window,
-			                    flags=Gtk.DialogFlags.MODAL | Gtk.DialogFlags.DESTROY_WITH_PARENT)
+			                    flags=Gtk.DialogFlags.DESTROY_WITH_PARENT)
+			dialog.add_button('gtk-cancel', Gtk.ResponseType.CANCEL)
 			pbar = Gtk.ProgressBar()
 			dialog.get_content_area().add(pbar)
 			pbar.show()
 
-			self._model.main_iter_emit_tif(filename, self.export_pdf_pb_updater, dialog, pbar)
+			job = self._model.main_iter_emit_tif(filename, self.export_pdf_pb_updater, dialog, pbar)
+			dialog.connect('response', self.export_response, job)
 
 			# Just return, the dialog will be destroyed by the pb updater
 			dialog.show()
@@ -236,11 +264,8 @@ class MainWindow(object):
 		result = fc.run()
 		if result == Gtk.ResponseType.OK:
 			uri = fc.get_filename()
-			model = Model(pdffile=uri)
-			self.pdf_view.props.model = model
-			self.build_view.props.model = model
-			self._model = model
-			self.update_ui()
+			model = Model(pdffile=uri, render_service=self._render_service)
+			self.set_model(model)
 		fc.destroy()
 	
 	def open_file(self, *args):
@@ -261,9 +286,16 @@ class MainWindow(object):
 		fc.destroy()
 
 	def load_file(self, filename):
-		model = Model(loadfile=filename)
+		model = Model(loadfile=filename, render_service=self._render_service)
+		self.set_model(model)
+
+	def set_model(self, model):
 		self.pdf_view.props.model = model
 		self.build_view.props.model = model
+
+		# Free the workers and caches of the previous project
+		if self._model is not None:
+			self._model.shutdown()
 		self._model = model
 		self.update_ui()
 		
@@ -291,6 +323,7 @@ class MainWindow(object):
 		if result == Gtk.ResponseType.OK:
 			if self._model is not None:
 				self._model.shutdown()
+			self._render_service.shutdown()
 			Gtk.main_quit()
 		else:
 			dialog.destroy()
@@ -24,6 +24,7 @@ import minigoo as GooCanvas
 from gi.repository import GObject
 import model
 import math
+import time
 
 _BOX = 1
 _EDGE_TOP = 2
@@ -31,6 +32,10 @@ _EDGE_BOTTOM = 4
 _EDGE_LEFT = 8
 _EDGE_RIGHT = 16
 _LINE_WIDTH = 2
+# Upper limit of pages to render ahead while scrolling
+_MAX_PREFETCH = 3
+# Do not queue more prefetches than can be rendered in this time (seconds)
+_PREFETCH_TIME = 1.0
 
 class Box(GooCanvas.CanvasItemSimple, GooCanvas.CanvasItem):
 	__gtype_name__ = "PDFViewBox"
@@ -245,13 +250,12 @@ class Page(GooCanvas.CanvasItemSimple, GooCanvas.CanvasItem):
 		cr.rectangle(self.x, self.y, self.width, self.height)
 		cr.fill()
 
-		x_offset = self.x * scale
-		y_offset = self.y * scale
-		x_offset = x_offset - math.floor(x_offset)
-		y_offset = y_offset - math.floor(y_offset)
-		x_offset = -x_offset / scale
-		y_offset = -y_offset / scale
-		result = self._model.get_rendered_page_or_queue(self._page, scale, x_offset, y_offset, cr.get_target())
+		x_offset, y_offset = self._get_render_offsets(scale)
+
+		# At high zoom levels the whole page is only rendered at a lower
+		# resolution, and the visible tiles are painted on top.
+		render_scale = self._model.get_page_render_scale(self._page, scale)
+		result = self._model.get_rendered_page_or_queue(self._page, render_scale, x_offset, y_offset, cr.get_target())
 		if result is None:
 			cr.translate(self.x + self.width / 2.0, self.y + self.height / 2.0)
 			cr.set_source_rgb(0.4, 0.4, 0.4)
@@ -259,28 +263,29 @@ class Page(GooCanvas.CanvasItemSimple, GooCanvas.CanvasItem):
 
 			height = extends[3]
 			width = extends[4]
-			scale = (self.width * 0.8) / width
-			cr.translate(- width * scale / 2.0 - extends[0] * scale, - height * scale / 2.0 - extends[1] * scale)
-			cr.scale(scale, scale)
+			tscale = (self.width * 0.8) / width
+			cr.translate(- width * tscale / 2.0 - extends[0] * tscale, - height * tscale / 2.0 - extends[1] * tscale)
+			cr.scale(tscale, tscale)
 
 			cr.move_to(0, 0)
 			cr.show_text("Loading ...")
-			cr.restore()
-			return
-
-		image = result[0]
-		iscale = result[1]
-		x_offset = result[2]
-		y_offset = result[3]
-		cr.rectangle(self.x, self.y, self.width, self.height)
-		cr.translate(self.x, self.y)
-		cr.translate(x_offset, y_offset)
-		cr.scale(1 / iscale, 1 / iscale)
-		cr.set_source_surface(image)
-		cr.fill()
+		else:
+			image = result[0]
+			iscale = result[1]
+			ix_offset = result[2]
+			iy_offset = result[3]
+			cr.rectangle(self.x, self.y, self.width, self.height)
+			cr.translate(self.x, self.y)
+			cr.translate(ix_offset, iy_offset)
+			cr.scale(1 / iscale, 1 / iscale)
+			cr.set_source_surface(image)
+			cr.fill()
 
 		cr.restore()
 
+		if render_scale < scale:
+			self._paint_tiles(cr, bounds, scale, x_offset, y_offset)
+
 		if self._drag_active:
 			cr.save()
 			lw = _LINE_WIDTH / scale
@@ -297,6 +302,54 @@ class Page(GooCanvas.CanvasItemSimple, GooCanvas.CanvasItem):
 			cr.stroke()
 			cr.restore()
 
+	def _get_render_offsets(self, scale):
+		# Renders are shifted so that they align with the pixel grid
+		x_offset = self.x * scale
+		y_offset = self.y * scale
+		x_offset = x_offset - math.floor(x_offset)
+		y_offset = y_offset - math.floor(y_offset)
+		x_offset = -x_offset / scale
+		y_offset = -y_offset / scale
+		return x_offset, y_offset
+
+	def prefetch(self, scale):
+		x_offset, y_offset = self._get_render_offsets(scale)
+		render_scale = self._model.get_page_render_scale(self._page, scale)
+		self._model.prefetch_page(self._page, render_scale, x_offset, y_offset)
+
+	def _paint_tiles(self, cr, bounds, scale, x_offset, y_offset):
+		tile_size = model.TILE_SIZE
+		# Tiles only exist for the scales on the ladder of the model
+		scale = model.quantize_scale(scale)
+
+		# The visible area in pixels of the rendered page
+		x1 = (max(bounds.x1, self.x) - self.x - x_offset) * scale
+		y1 = (max(bounds.y1, self.y) - self.y - y_offset) * scale
+		x2 = (min(bounds.x2, self.x + self.width) - self.x - x_offset) * scale
+		y2 = (min(bounds.y2, self.y + self.height) - self.y - y_offset) * scale
+
+		# The page is rendered with the same size in pixels as in the model
+		last_tile_x = (int(self.width * scale + 1) - 1) // tile_size
+		last_tile_y = (int(self.height * scale + 1) - 1) // tile_size
+
+		cr.save()
+		cr.rectangle(self.x, self.y, self.width, self.height)
+		cr.clip()
+		cr.translate(self.x + x_offset, self.y + y_offset)
+		cr.scale(1 / scale, 1 / scale)
+
+		for tile_y in xrange(max(0, int(y1 // tile_size)), min(int(y2 // tile_size), last_tile_y) + 1):
+			for tile_x in xrange(max(0, int(x1 // tile_size)), min(int(x2 // tile_size), last_tile_x) + 1):
+				result = self._model.get_rendered_tile_or_queue(self._page, scale, tile_x, tile_y, x_offset, y_offset, cr.get_target())
+				if result is None:
+					continue
+
+				cr.set_source_surface(result[0], tile_x * tile_size, tile_y * tile_size)
+				cr.rectangle(tile_x * tile_size, tile_y * tile_size, tile_size, tile_size)
+				cr.fill()
+
+		cr.restore()
+
 	def do_key_press_event(self, target, event):
 		if Gdk.keyval_name(event.keyval) == 'Escape':
 			self._drag_active = False
@@ -350,7 +403,14 @@ class PDFView(GooCanvas.Canvas):
 		self.add_events(Gdk.EventMask.SMOOTH_SCROLL_MASK)
 		self._smooth_zoom = 0
 
+		# Used to prefetch the pages in scroll direction
+		self._scroll_pos = None
+		self._scroll_time = None
+		self._scroll_velocity = 0.0
+		self._scroll_direction = 1
+
 		self.connect('draw', self.update_page_label)
+		self.connect('draw', self._update_visible_pages)
 
 	def set_model(self, model):
 		if self._model:
@@ -411,6 +471,52 @@ class PDFView(GooCanvas.Canvas):
 		dbox = self._boxes.pop(box)
 		dbox.remove()
 
+	def _update_visible_pages(self, *args):
+		if self._model is None:
+			return
+
+		bounds = self.get_visible_bounds()
+		pages = [i for i, page in enumerate(self._pages)
+		         if page.y <= bounds.y2 and page.y + page.height >= bounds.y1]
+		self._model.set_visible_pages(pages)
+
+		self._update_scroll_velocity(bounds)
+		if pages:
+			self._prefetch_pages(pages[0], pages[-1])
+
+	def _update_scroll_velocity(self, bounds):
+		now = time.time()
+		if self._scroll_time is not None and now > self._scroll_time and self._pages:
+			page_height = self._pages[0].height
+			velocity = (bounds.y1 - self._scroll_pos) / page_height / (now - self._scroll_time)
+			# Smooth it a bit, we get drawn for other reasons too
+			self._scroll_velocity = 0.5 * self._scroll_velocity + 0.5 * velocity
+
+		if self._scroll_pos is not None and bounds.y1 != self._scroll_pos:
+			self._scroll_direction = 1 if bounds.y1 > self._scroll_pos else -1
+
+		self._scroll_pos = bounds.y1
+		self._scroll_time = now
+
+	def _prefetch_pages(self, first, last):
+		# Render the pages that are scrolled into view during the time one
+		# render takes, but not more than the workers can handle.
+		depth = 1
+		render_time = self._model.get_page_render_time()
+		if render_time:
+			depth += int(math.ceil(abs(self._scroll_velocity) * render_time))
+			depth = min(depth, max(1, int(_PREFETCH_TIME / render_time)))
+		depth = min(depth, _MAX_PREFETCH)
+
+		if self._scroll_direction > 0:
+			pages = xrange(last + 1, min(last + 1 + depth, len(self._pages)))
+		else:
+			pages = xrange(first - 1, max(first - 1 - depth, -1), -1)
+
+		scale = self.get_scale()
+		for i in pages:
+			self._pages[i].prefetch(scale)
+
 	def update_page_label(self, *args):
 		pages = len(self._pages)
 		ypos = self.get_vadjustment().get_value()
@@ -474,7 +580,16 @@ class PDFView(GooCanvas.Canvas):
 		if scale <= 0.2 and zoom < 1:
 			return True
 		
-		scale *= zoom
+		# Step along the scale ladder of the model so that renders can be
+		# reused when zooming back
+		level = model.get_scale_level(scale)
+		if zoom > 1:
+			level += 1
+		else:
+			level -= 1
+		new_scale = model.get_level_scale(level)
+		zoom = new_scale / scale
+		scale = new_scale
 		self.set_scale(scale)
 
 		if self.get_hadjustment() and self.get_vadjustment():
@@ -0,0 +1,425 @@
+# -*- coding: utf-8 -*-
+# PDFCutter
+#
+# Copyright (C) 2009, Benjamin Berg <benjamin@sipsolutions.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import multiprocessing
+from gi.repository import GLib
+from gprocess import GProcess
+import shmsurface
+
+# How often to check whether the workers are still alive, in ms
+SUPERVISE_INTERVAL = 500
+
+class RenderError(Exception):
+	"""Raised by a render function if a job cannot be rendered. The message
+	is sent back to the main process as an error reply."""
+	pass
+
+class _Worker(object):
+	def __init__(self):
+		self.process = None
+		self.pipe_p, self.pipe_c = multiprocessing.Pipe()
+		# The requests that have been sent to this worker, in order
+		self.requests = []
+		# When the worker started on the first request in the list
+		self.busy_since = None
+
+class RenderPool(object):
+	"""A pool of worker processes that render jobs for the main process.
+
+	Jobs are kept in a queue in the main process and are handed out to the
+	workers as soon as they have room for more work. Every job is tagged with
+	a request ID, the protocol over the pipes is:
+
+	  parent -> worker: ('render', [(request_id, job), ...]) or 'quit'
+	  worker -> parent: (request_id, 'ok', data) or (request_id, 'error', msg)
+
+	The worker sends one reply for every request, in order.
+
+	Results can arrive in any order and are routed back by their request ID.
+	Up to max_in_flight requests are sent to each worker at a time so that it
+	can continue with the next job right away.
+
+	Every job has a key which only lives in the main process (e.g. the item
+	the job was created for). There is at most one queued job for every key,
+	submitting a new job replaces the queued one in place. Jobs with a lower
+	priority value are handed out first, and queued jobs can be cancelled.
+
+	render_func is called with the job inside the
+	worker process and has to return something that can be sent over a pipe.
+	result_cb is called with the key, the job and that result in the main
+	process. If render_func raises an exception, error_cb is called with the
+	key, the job and the error message instead.
+
+	If group_func is given, jobs for which it returns the same value (e.g.
+	the same source page) are handed out together, up to max_batch at a
+	time. render_func is called with the list of jobs then, and has to
+	return an iterator with one result per job. A failed job is signalled
+	by an exception instance in place of its result.
+
+	If affinity_func is given, jobs for which it returns the same value (e.g.
+	the same page, which the worker keeps in memory) are handed to the worker
+	that got the last such job. They wait for it while it is busy, unless
+	another worker has nothing to do.
+
+	If a worker process dies (e.g. because poppler crashed), a new worker is
+	started. The job it was rendering is retried once, if the new worker dies
+	on it as well, error_cb is called for it. The shared memory surfaces
+	(see shmsurface) the worker left behind are removed.
+
+	init_func is called in every worker process before the first job.
+	idle_func is called in the worker process while no request is waiting,
+	for work that should not delay the replies. It does a small part of the
+	work at a time and returns True if there is more to do.
+
+	If time_budget is given, a worker that needs more than time_budget
+	seconds for one job is killed and replaced. timeout_cb is called with the
+	key and the job then (or error_cb if there is no timeout_cb), the job is
+	not retried."""
+
+	def __init__(self, render_func, result_cb, error_cb=None, workers=None, max_in_flight=2,
+	             init_func=None, time_budget=None, timeout_cb=None, group_func=None, max_batch=16,
+	             idle_func=None, affinity_func=None):
+		if workers is None:
+			workers = multiprocessing.cpu_count()
+
+		self._render_func = render_func
+		self._result_cb = result_cb
+		self._error_cb = error_cb
+		self._init_func = init_func
+		self._idle_func = idle_func
+		self._time_budget = time_budget
+		self._timeout_cb = timeout_cb
+		self._group_func = group_func
+		self._max_batch = max(1, max_batch)
+		self._affinity_func = affinity_func
+		# affinity value -> the worker that got the last job for it
+		self._affinity = {}
+		self._max_in_flight = max(1, max_in_flight)
+		self._parent_pid = os.getpid()
+
+		self._next_request_id = 0
+		# Jobs that have not been handed to a worker yet,
+		# as [priority, id, key, job]
+		self._queue = []
+		# request ID -> (priority, key, job) for everything that is handed
+		# to a worker
+		self._in_flight = {}
+		# (key, job) of the jobs that a worker died on
+		self._crashed = set()
+		# Requests that were cancelled after they were handed to a worker,
+		# they are not queued again if the worker dies
+		self._cancelled = set()
+		self._supervise_id = None
+
+		# Moving average of the time a worker needs for one job
+		self._average_time = None
+
+		self._workers = []
+		for i in xrange(max(1, workers)):
+			self._workers.append(self._create_worker())
+
+	def _create_worker(self):
+		worker = _Worker()
+		worker.process = GProcess(target=self._worker_proc, args=(worker,), childcb=self._worker_wakeup)
+		return worker
+
+	def start(self):
+		for worker in self._workers:
+			worker.process.start()
+		self._supervise_id = GLib.timeout_add(SUPERVISE_INTERVAL, self._supervise)
+
+	def submit(self, key, job, priority=0):
+		"""Queue a job for rendering. A queued job for the same key is
+		replaced by the new one, which keeps its place in the queue. Returns
+		the request ID, or None if the same job is already queued or being
+		rendered for this key."""
+		for request_id, (queued_priority, queued_key, queued_job) in self._in_flight.iteritems():
+			if queued_key == key and queued_job == job:
+				# Anything queued for the key is outdated now
+				self.cancel(key)
+				self._cancelled.discard(request_id)
+				return None
+
+		for item in self._queue:
+			if item[2] == key:
+				if item[3] == job:
+					item[0] = min(item[0], priority)
+					return None
+
+				# Superseded by the new job, the latest one wins
+				item[0] = priority
+				item[3] = job
+				return item[1]
+
+		request_id = self._next_request_id
+		self._next_request_id += 1
+
+		self._queue.append([priority, request_id, key, job])
+		self._dispatch()
+
+		return request_id
+
+	def get_worker_count(self):
+		return len(self._workers)
+
+	def get_average_time(self):
+		"""Returns the average time in seconds a worker needs for a job, or
+		None if nothing has been rendered yet."""
+		return self._average_time
+
+	def cancel(self, key):
+		"""Drop the queued job for key. Jobs that have been handed to a
+		worker already will still finish, but they are not retried if the
+		worker dies."""
+		self.cancel_matching(lambda queued_key: queued_key == key)
+
+	def cancel_matching(self, func):
+		"""Drop all queued jobs for which func(key) returns True."""
+		self._queue = [item for item in self._queue if not func(item[2])]
+		for request_id, (priority, key, job) in self._in_flight.iteritems():
+			if func(key):
+				self._cancelled.add(request_id)
+
+	def _has_room(self, worker):
+		# Dead workers will be replaced by _supervise
+		return len(worker.requests) < self._max_in_flight and worker.process.is_alive()
+
+	def _choose_worker(self, job):
+		# The worker with the job's affinity if it has room, otherwise the
+		# least loaded one. Returns None if the job should wait.
+		preferred = None
+		if self._affinity_func is not None:
+			preferred = self._affinity.get(self._affinity_func(job))
+		if preferred is not None and self._has_room(preferred):
+			return preferred
+
+		workers = [worker for worker in self._workers if self._has_room(worker)]
+		if not workers:
+			return None
+		worker = min(workers, key=lambda worker: len(worker.requests))
+		if preferred is not None and worker.requests:
+			# Rather wait for the worker that has the data already
+			return None
+		return worker
+
+	def _dispatch(self):
+		# Hand out the work by priority, the least loaded workers first
+		self._queue.sort()
+		for item in list(self._queue):
+			if not any(self._has_room(worker) for worker in self._workers):
+				return
+			if item not in self._queue:
+				# Handed out as part of a batch
+				continue
+
+			worker = self._choose_worker(item[3])
+			if worker is None:
+				continue
+
+			batch = self._take_batch(item)
+			if not worker.requests:
+				worker.busy_since = time.time()
+			for priority, request_id, key, job in batch:
+				worker.requests.append(request_id)
+				self._in_flight[request_id] = (priority, key, job)
+				if self._affinity_func is not None:
+					self._affinity[self._affinity_func(job)] = worker
+			worker.pipe_p.send(('render', [(item[1], item[3]) for item in batch]))
+
+	def _take_batch(self, item):
+		# Removes the item from the queue, together with the queued jobs of
+		# the same group.
+		self._queue.remove(item)
+		if self._group_func is None:
+			return [item]
+
+		group = self._group_func(item[3])
+		batch = [item]
+		for item in list(self._queue):
+			if len(batch) >= self._max_batch:
+				break
+			if self._group_func(item[3]) == group:
+				self._queue.remove(item)
+				batch.append(item)
+		return batch
+
+	def _worker_proc(self, worker):
+		# This function runs in a separate process!
+		if self._init_func is not None:
+			self._init_func()
+
+		while True:
+			if self._idle_func is not None:
+				while not worker.pipe_c.poll() and self._idle_func():
+					pass
+
+			obj = worker.pipe_c.recv()
+			if obj == 'quit':
+				return
+
+			cmd, batch = obj
+			if self._group_func is None:
+				results = self._render_each([job for request_id, job in batch])
+			else:
+				results = iter(self._render_func([job for request_id, job in batch]))
+
+			for request_id, job in batch:
+				try:
+					result = results.next()
+					if isinstance(result, Exception):
+						raise result
+					reply = (request_id, 'ok', result)
+				except StopIteration:
+					reply = (request_id, 'error', 'The job was not rendered')
+				except Exception, e:
+					reply = (request_id, 'error', str(e))
+
+				# Wake parent first (in case data does not fit into buffer)
+				worker.process.wake_parent()
+				worker.pipe_c.send(reply)
+
+	def _render_each(self, jobs):
+		# This function runs in a separate process!
+		for job in jobs:
+			try:
+				yield self._render_func(job)
+			except Exception, e:
+				yield e
+
+	def _worker_wakeup(self, proc):
+		for worker in self._workers:
+			if worker.process is proc:
+				break
+		else:
+			return
+
+		self._handle_reply(worker)
+
+	def _handle_reply(self, worker):
+		request_id, status, data = worker.pipe_p.recv()
+		priority, key, job = self._in_flight.pop(request_id)
+		worker.requests.remove(request_id)
+		self._crashed.discard((key, job))
+		self._cancelled.discard(request_id)
+
+		now = time.time()
+		if self._average_time is None:
+			self._average_time = now - worker.busy_since
+		else:
+			self._average_time = 0.8 * self._average_time + 0.2 * (now - worker.busy_since)
+		# The worker continues with the next request right away
+		if worker.requests:
+			worker.busy_since = now
+		else:
+			worker.busy_since = None
+
+		# Keep the worker busy before handling the result
+		self._dispatch()
+
+		if status == 'ok':
+			self._result_cb(key, job, data)
+		elif self._error_cb is not None:
+			self._error_cb(key, job, data)
+
+	def _supervise(self):
+		now = time.time()
+		for i, worker in enumerate(self._workers):
+			timed_out = None
+			if self._time_budget is not None and worker.busy_since is not None and \
+			   now - worker.busy_since > self._time_budget:
+				timed_out = worker.requests[0]
+				worker.process.terminate()
+				worker.process.join(1)
+			elif worker.process.is_alive():
+				continue
+
+			self._workers[i] = self._create_worker()
+			self._workers[i].process.start()
+			self._worker_died(worker, timed_out)
+
+		self._dispatch()
+		return True
+
+	def _worker_died(self, worker, timed_out=None):
+		# timed_out is the request the worker was killed for, if any
+
+		# Handle the replies that were sent before the worker died
+		while worker.pipe_p.poll():
+			self._handle_reply(worker)
+		worker.process.close_pipe()
+		worker.pipe_p.close()
+		worker.pipe_c.close()
+		for affinity, affine_worker in self._affinity.items():
+			if affine_worker is worker:
+				del self._affinity[affinity]
+		# Renders that were never sent, or are still in the pipe
+		shmsurface.discard_process(worker.process.pid)
+
+		for i, request_id in enumerate(worker.requests):
+			priority, key, job = self._in_flight.pop(request_id)
+
+			if request_id in self._cancelled:
+				# Nobody is waiting for it anymore
+				self._cancelled.discard(request_id)
+				continue
+
+			if request_id == timed_out:
+				if self._timeout_cb is not None:
+					self._timeout_cb(key, job)
+				elif self._error_cb is not None:
+					self._error_cb(key, job, 'Rendering took too long')
+				continue
+
+			if i == 0 and timed_out is None:
+				# The worker died while rendering this job
+				if (key, job) in self._crashed:
+					self._crashed.discard((key, job))
+					if self._error_cb is not None:
+						self._error_cb(key, job, 'The render process died')
+					continue
+				self._crashed.add((key, job))
+
+			# Queue the job again unless it has been superseded, it keeps
+			# its place in the queue.
+			for item in self._queue:
+				if item[2] == key:
+					break
+			else:
+				self._queue.append([priority, request_id, key, job])
+		worker.requests = []
+
+	def shutdown(self):
+		# Let the subprocesses quit.
+		if os.getpid() != self._parent_pid:
+			return
+
+		if self._supervise_id is not None:
+			GLib.source_remove(self._supervise_id)
+			self._supervise_id = None
+
+		for worker in self._workers:
+			worker.pipe_p.send('quit')
+
+		for worker in self._workers:
+			worker.process.join(2)
+			worker.process.terminate()
+			worker.process.join()
+			# The replies that were not handled anymore
+			shmsurface.discard_process(worker.process.pid)
@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+# PDFCutter
+#
+# Copyright (C) 2009, Benjamin Berg <benjamin@sipsolutions.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The render workers of the application.
+
+A RenderService owns the worker processes, which stay alive while documents
+are opened and closed. Every model attaches to the service and gets a client
+for the box and the page pool, which behaves like a RenderPool of its own."""
+
+import os
+import math
+import multiprocessing
+import cairo
+from gi.repository import Poppler
+from renderpool import RenderPool, RenderError
+from lru import LRU, WeightedLRU
+import shmsurface
+
+# Pages are rendered as tiles of TILE_SIZE pixels at high zoom levels
+TILE_SIZE = 256
+
+# Box renders do not depend on where the box is placed. They have a margin of
+# this many pixels, so that they can be shifted onto the pixel grid.
+BOX_RENDER_MARGIN = 1
+
+# A render job that takes longer than this many seconds is aborted
+RENDER_TIME_BUDGET = 15.0
+
+# Every render worker keeps this many documents open
+OPEN_DOCUMENTS = 4
+
+# The render workers keep the drawing operations of recently rendered pages,
+# so that poppler does not have to interpret them again. Together they use
+# about this many bytes for it. Jobs for a page go to the worker that
+# recorded it.
+RECORDING_MEMORY_BUDGET = 256 * 1024 * 1024
+
+# The memory a recording needs is not known. Scanned pages keep their
+# images, so it is estimated as the page at this resolution with 4 bytes per
+# pixel.
+RECORDING_DPI = 300
+
+# Renders are written to the disk cache once the worker is idle. If it does
+# not get to it, only this many are kept waiting.
+MAX_PENDING_STORES = 8
+
+def get_box_render_size(scale, width, height):
+	"""Returns the size in pixels of a box render, including the margin."""
+	return int(math.ceil(width * scale)) + 2 * BOX_RENDER_MARGIN, int(math.ceil(height * scale)) + 2 * BOX_RENDER_MARGIN
+
+class RenderClient(object):
+	"""The view of one model on a pool of the service. It has the same
+	interface as a RenderPool, but only sees the jobs of its model. Jobs are
+	rendered for the document the client was attached with."""
+
+	def __init__(self, service, pool, document, result_cb, error_cb, timeout_cb):
+		self.document = document
+		self.attached = True
+		self._service = service
+		self._pool = pool
+		self._result_cb = result_cb
+		self._error_cb = error_cb
+		self._timeout_cb = timeout_cb
+
+	def submit(self, key, job, priority=0):
+		# The workers are only started once there is something to render
+		self._service.start()
+		return self._pool.submit((self, key), (self.document, job), priority)
+
+	def cancel(self, key):
+		self._pool.cancel((self, key))
+
+	def cancel_matching(self, func):
+		self._pool.cancel_matching(lambda key: key[0] is self and func(key[1]))
+
+	def get_worker_count(self):
+		return self._pool.get_worker_count()
+
+	def get_average_time(self):
+		return self._pool.get_average_time()
+
+	def detach(self):
+		"""Drop all queued jobs, results of running jobs are discarded."""
+		self.attached = False
+		self._pool.cancel_matching(lambda key: key[0] is self)
+
+class RenderService(object):
+	"""Worker processes that render pages, tiles and boxes for all models.
+
+	Boxes are rendered by a single worker, pages and tiles by a pool of
+	page_render_workers (one per core by default). disk_cache is an optional
+	diskcache.DiskCache, time_budget is passed to the pools.
+
+	The workers are started with start(), or when the first job is
+	submitted."""
+
+	def __init__(self, page_render_workers=None, disk_cache=None, time_budget=RENDER_TIME_BUDGET):
+		if page_render_workers is None:
+			page_render_workers = multiprocessing.cpu_count()
+
+		self._disk_cache = disk_cache
+		self._started = False
+		# Shared by the box worker and the page workers
+		self._recording_budget = RECORDING_MEMORY_BUDGET / (page_render_workers + 1)
+
+		# Box jobs are handed out in batches of boxes on the same source page
+		self._box_render_pool = RenderPool(self._box_render_batch, self._rendered, self._failed,
+		                                   workers=1, init_func=self._init_worker, idle_func=self._store_pending,
+		                                   time_budget=time_budget, timeout_cb=self._timed_out,
+		                                   group_func=self._get_box_job_page)
+		self._page_render_pool = RenderPool(self._page_render_job, self._rendered, self._failed,
+		                                    workers=page_render_workers, init_func=self._init_worker, idle_func=self._store_pending,
+		                                    time_budget=time_budget, timeout_cb=self._timed_out,
+		                                    affinity_func=self._get_page_job_page)
+
+	def start(self):
+		if self._started:
+			return
+		self._started = True
+		self._box_render_pool.start()
+		self._page_render_pool.start()
+
+	def attach(self, pdffile, box_result_cb, page_result_cb, error_cb, timeout_cb):
+		"""Attach a model that shows pdffile. Returns the clients for the box
+		and the page pool, error_cb and timeout_cb are used for both."""
+		st = os.stat(pdffile)
+
+		# The workers open the document by its path, the modification time
+		# makes sure that a changed file is opened again. The size is part of
+		# the disk cache key as well, reading the whole file to hash it would
+		# block the user interface for large documents.
+		document = (pdffile, st.st_mtime, st.st_size)
+		box_client = RenderClient(self, self._box_render_pool, document, box_result_cb, error_cb, timeout_cb)
+		page_client = RenderClient(self, self._page_render_pool, document, page_result_cb, error_cb, timeout_cb)
+		return box_client, page_client
+
+	def shutdown(self):
+		if not self._started:
+			return
+		self._box_render_pool.shutdown()
+		self._page_render_pool.shutdown()
+
+	def _rendered(self, key, job, handle):
+		client, key = key
+		if not client.attached:
+			shmsurface.discard(handle)
+			return
+		client._result_cb(key, job[1], handle)
+
+	def _failed(self, key, job, message):
+		client, key = key
+		if client.attached:
+			client._error_cb(key, job[1], message)
+
+	def _timed_out(self, key, job):
+		client, key = key
+		if client.attached:
+			client._timeout_cb(key, job[1])
+
+	def _get_box_job_page(self, job):
+		document, data = job
+		return document, data[1]
+
+	def _get_page_job_page(self, job):
+		# Pages and tiles both start with the page number
+		document, (kind, data) = job
+		return document, data[0]
+
+	def _init_worker(self):
+		# This function runs in a separate process!
+		self._documents = LRU(OPEN_DOCUMENTS, get_func=self._open_document)
+		# (document, page number) -> (recording, estimated size)
+		self._recorded_pages = WeightedLRU(self._recording_budget, lambda entry: entry[1])
+		# (key, handle, file) of renders that still need to be stored
+		self._pending_stores = []
+
+	def _open_document(self, document):
+		# This function runs in a separate process!
+		# Use self._documents(document) to get the open document
+		return Poppler.Document.new_from_file('file://' + document[0], None)
+
+	def _box_render_batch(self, jobs):
+		# This function runs in a separate process!
+		# All boxes are on the same source page, which is recorded only once
+		for document, data in jobs:
+			try:
+				yield self._render_with_disk_cache(document, 'box', data, self._render_box)
+			except Exception, e:
+				# Only this box failed, continue with the others
+				yield e
+
+	def _page_render_job(self, job):
+		# This function runs in a separate process!
+		document, (kind, data) = job
+		if kind == 'tile':
+			return self._render_with_disk_cache(document, kind, data, self._render_tile)
+		else:
+			return self._render_with_disk_cache(document, kind, data, self._render_page)
+
+	def _render_with_disk_cache(self, document, kind, data, render_func):
+		# This function runs in a separate process!
+		if self._disk_cache is None:
+			return render_func(document, data)
+
+		# Round scales and offsets, so that they match after reloading
+		key = [repr(value) for value in document]
+		key.append(kind)
+		for value in data:
+			if isinstance(value, float):
+				key.append('%.4f' % value)
+			else:
+				key.append(str(value))
+		key = ' '.join(key)
+
+		handle = self._disk_cache.load(key)
+		if handle is None:
+			handle = render_func(document, data)
+
+			# Stored after the reply is sent, the file is opened now because
+			# the main process removes it once it gets the reply.
+			self._pending_stores.append((key, handle, open(handle[0], 'rb')))
+			if len(self._pending_stores) > MAX_PENDING_STORES:
+				self._pending_stores.pop(0)[2].close()
+
+		return handle
+
+	def _store_pending(self):
+		# This function runs in a separate process!
+		# Called while the worker has nothing to do, stores one render
+		if not self._pending_stores:
+			return False
+
+		key, handle, source = self._pending_stores.pop(0)
+		self._disk_cache.store(key, handle, source)
+		return True
+
+	def _get_recording(self, document, page_number):
+		# This function runs in a separate process!
+		key = (document, page_number)
+		if key in self._recorded_pages:
+			return self._recorded_pages[key][0]
+
+		page = self._documents(document).get_page(page_number)
+		width, height = page.get_size()
+		recording = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA, (0, 0, width, height))
+		cr = cairo.Context(recording)
+		page.render_for_printing(cr)
+
+		size = int(width * height * (RECORDING_DPI / 72.0) ** 2 * 4)
+		self._recorded_pages[key] = (recording, size)
+		return recording
+
+	def _paint_page(self, cr, document, page_number):
+		# This function runs in a separate process!
+		# The page is replayed from its recording, at any scale and clip
+		cr.set_source_surface(self._get_recording(document, page_number), 0, 0)
+		cr.paint()
+
+	def _get_page_size(self, document, page_number):
+		# This function runs in a separate process!
+		return self._documents(document).get_page(page_number).get_size()
+
+	def _render_box(self, document, data):
+		# This function runs in a separate process!
+		scale, page_number, x, y, width, height = data
+
+		scaled_width, scaled_height = get_box_render_size(scale, width, height)
+
+		try:
+			surface, handle = shmsurface.create(cairo.FORMAT_ARGB32, scaled_width, scaled_height)
+		except MemoryError:
+			raise RenderError("Cannot render box at this zoom, not enough memory!")
+
+		cr = cairo.Context(surface)
+		cr.set_source_rgba(0, 0, 0, 0)
+		cr.set_operator(cairo.OPERATOR_SOURCE)
+		cr.paint()
+
+		cr.set_operator(cairo.OPERATOR_OVER)
+		cr.translate(BOX_RENDER_MARGIN, BOX_RENDER_MARGIN)
+		cr.scale(scale, scale)
+		cr.translate(-x, -y)
+		self._paint_page(cr, document, page_number)
+		surface.flush()
+
+		# Only the handle is sent, the data is in shared memory
+		return handle
+
+	def _render_page(self, document, data):
+		# This function runs in a separate process!
+		page_number, scale, x_offset, y_offset = data
+
+		width, height = self._get_page_size(document, page_number)
+		width *= scale
+		height *= scale
+		try:
+			surface, handle = shmsurface.create(cairo.FORMAT_RGB24, int(width + 1), int(height + 1))
+		except MemoryError:
+			raise RenderError("Cannot render page at this zoom, not enough memory!")
+
+		cr = cairo.Context(surface)
+		cr.set_source_rgba(1, 1, 1)
+		cr.paint()
+
+		cr.scale(scale, scale)
+		cr.translate(-x_offset, -y_offset)
+		self._paint_page(cr, document, page_number)
+		surface.flush()
+
+		return handle
+
+	def _render_tile(self, document, data):
+		# This function runs in a separate process!
+		page_number, scale, tile_x, tile_y, x_offset, y_offset = data
+
+		width, height = self._get_page_size(document, page_number)
+		# Same size as the whole page would have, cut to the tile
+		width = min(int(width * scale + 1) - tile_x * TILE_SIZE, TILE_SIZE)
+		height = min(int(height * scale + 1) - tile_y * TILE_SIZE, TILE_SIZE)
+		if width <= 0 or height <= 0:
+			raise RenderError("Tile %i, %i is outside of page %i!" % (tile_x, tile_y, page_number))
+
+		try:
+			surface, handle = shmsurface.create(cairo.FORMAT_RGB24, width, height)
+		except MemoryError:
+			raise RenderError("Cannot render tile, not enough memory!")
+
+		cr = cairo.Context(surface)
+		cr.set_source_rgba(1, 1, 1)
+		cr.paint()
+
+		cr.translate(-tile_x * TILE_SIZE, -tile_y * TILE_SIZE)
+		cr.scale(scale, scale)
+		cr.translate(-x_offset, -y_offset)
+		self._paint_page(cr, document, page_number)
+		surface.flush()
+
+		return handle
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# PDFCutter
+#
+# Copyright (C) 2009, Benjamin Berg <benjamin@sipsolutions.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Image surfaces that live in shared memory.
+
+A render worker creates a surface with create() and draws into it. Only the
+small handle is sent to the main process, which maps the same memory again
+with open(). The pixel data is never copied.
+
+The files are named after the process that created them. If it dies before
+the main process opened them, they are removed with discard_process()."""
+
+import os
+import glob
+import mmap
+import tempfile
+import cairo
+
+# Prefer a tmpfs so the data never hits the disk
+if os.path.isdir('/dev/shm'):
+	_SHM_DIR = '/dev/shm'
+else:
+	_SHM_DIR = tempfile.gettempdir()
+
+def _get_prefix(pid):
+	return 'pdfcutter-%i-' % pid
+
+def _map(fd, size):
+	return mmap.mmap(fd, size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+
+def create(format, width, height):
+	"""Create an image surface backed by shared memory. Returns the surface
+	and the handle that has to be passed to open(). Raises MemoryError if
+	the memory cannot be allocated."""
+	stride = cairo.ImageSurface.format_stride_for_width(format, width)
+	size = stride * height
+
+	fd, path = tempfile.mkstemp(prefix=_get_prefix(os.getpid()), dir=_SHM_DIR)
+	try:
+		try:
+			os.ftruncate(fd, size)
+			data = _map(fd, size)
+		finally:
+			os.close(fd)
+	except EnvironmentError:
+		os.unlink(path)
+		raise MemoryError
+
+	surface = cairo.ImageSurface.create_for_data(data, format, width, height, stride)
+
+	return surface, (path, format, width, height, stride)
+
+def open(handle):
+	"""Map the surface for the handle in this process. The handle becomes
+	invalid, the memory is freed once the surface is gone."""
+	path, format, width, height, stride = handle
+
+	fd = os.open(path, os.O_RDWR)
+	try:
+		os.unlink(path)
+		data = _map(fd, stride * height)
+	finally:
+		os.close(fd)
+
+	return cairo.ImageSurface.create_for_data(data, format, width, height, stride)
+
+def discard(handle):
+	"""Free the memory for a handle that will not be opened."""
+	try:
+		os.unlink(handle[0])
+	except OSError:
+		pass
+
+def discard_process(pid):
+	"""Free the memory of all handles created by the process pid, which has
+	to be dead."""
+	for path in glob.glob(os.path.join(_SHM_DIR, _get_prefix(pid) + '*')):
+		try:
+			os.unlink(path)
+		except OSError:
+			pass
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+# PDFCutter
+#
+# Copyright (C) 2009, Benjamin Berg <benjamin@sipsolutions.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Monochrome multipage TIFF files with CCITT Group 4 compression.
+
+Rows are passed to the encoder as strings with one character per pixel,
+WHITE or BLACK."""
+
+import struct
+import binascii
+
+WHITE = '\x00'
+BLACK = '\x01'
+
+# Run length codes of T.4, terminating codes for 0 to 63 and make up codes
+# for multiples of 64 up to 1728.
+_WHITE_CODES = [
+	'00110101', '000111', '0111', '1000', '1011', '1100', '1110', '1111',
+	'10011', '10100', '00111', '01000', '001000', '000011', '110100', '110101',
+	'101010', '101011', '0100111', '0001100', '0001000', '0010111', '0000011', '0000100',
+	'0101000', '0101011', '0010011', '0100100', '0011000', '00000010', '00000011', '00011010',
+	'00011011', '00010010', '00010011', '00010100', '00010101', '00010110', '00010111', '00101000',
+	'00101001', '00101010', '00101011', '00101100', '00101101', '00000100', '00000101', '00001010',
+	'00001011', '01010010', '01010011', '01010100', '01010101', '00100100', '00100101', '01011000',
+	'01011001', '01011010', '01011011', '01001010', '01001011', '00110010', '00110011', '00110100',
+	# 64 to 1728
+	'11011', '10010', '010111', '0110111', '00110110', '00110111', '01100100', '01100101',
+	'01101000', '01100111', '011001100', '011001101', '011010010', '011010011', '011010100', '011010101',
+	'011010110', '011010111', '011011000', '011011001', '011011010', '011011011', '010011000', '010011001',
+	'010011010', '011000', '010011011',
+]
+
+_BLACK_CODES = [
+	'0000110111', '010', '11', '10', '011', '0011', '0010', '00011',
+	'000101', '000100', '0000100', '0000101', '0000111', '00000100', '00000111', '000011000',
+	'0000010111', '0000011000', '0000001000', '00001100111', '00001101000', '00001101100', '00000110111', '00000101000',
+	'00000010111', '00000011000', '000011001010', '000011001011', '000011001100', '000011001101', '000001101000', '000001101001',
+	'000001101010', '000001101011', '000011010010', '000011010011', '000011010100', '000011010101', '000011010110', '000011010111',
+	'000001101100', '000001101101', '000011011010', '000011011011', '000001010100', '000001010101', '000001010110', '000001010111',
+	'000001100100', '000001100101', '000001010010', '000001010011', '000000100100', '000000110111', '000000111000', '000000100111',
+	'000000101000', '000001011000', '000001011001', '000000101011', '000000101100', '000001011010', '000001100110', '000001100111',
+	# 64 to 1728
+	'0000001111', '000011001000', '000011001001', '000001011011', '000000110011', '000000110100', '000000110101', '0000001101100',
+	'0000001101101', '0000001001010', '0000001001011', '0000001001100', '0000001001101', '0000001110010', '0000001110011', '0000001110100',
+	'0000001110101', '0000001110110', '0000001110111', '0000001010010', '0000001010011', '0000001010100', '0000001010101', '0000001011010',
+	'0000001011011', '0000001100100', '0000001100101',
+]
+
+# Make up codes for multiples of 64 from 1792 to 2560, the same for both
+# colours
+_EXTENDED_CODES = [
+	'00000001000', '00000001100', '00000001101', '000000010010', '000000010011', '000000010100', '000000010101',
+	'000000010110', '000000010111', '000000011100', '000000011101', '000000011110', '000000011111',
+]
+
+_WHITE_CODES += _EXTENDED_CODES
+_BLACK_CODES += _EXTENDED_CODES
+
+_PASS = '0001'
+_HORIZONTAL = '001'
+# Vertical mode for b1 - a1 from -3 to 3
+_VERTICAL = ['0000011', '000011', '011', '1', '010', '000010', '0000010']
+_EOFB = '000000000001' * 2
+
+def _run_codes(length, codes):
+	result = []
+	while length >= 2624:
+		result.append(codes[63 + 2560 // 64])
+		length -= 2560
+	if length >= 64:
+		result.append(codes[63 + length // 64])
+		length %= 64
+	result.append(codes[length])
+	return ''.join(result)
+
+def _bits_to_bytes(bits):
+	# bits has to be a multiple of 8 long
+	if not bits:
+		return ''
+	return binascii.unhexlify('%0*x' % (len(bits) // 4, int(bits, 2)))
+
+class G4Encoder(object):
+	"""Encoder for CCITT Group 4 (T.6) compressed data. Rows are added one
+	after the other, and the encoded data can be taken at any time."""
+
+	def __init__(self, width):
+		self.width = width
+		# Rows start with an imaginary white reference line
+		self._reference = WHITE * width
+		self._bits = []
+
+	def _find_change(self, row, start, color):
+		# The first position from start on that does not have color
+		if start >= self.width:
+			return self.width
+		if color == WHITE:
+			pos = row.find(BLACK, start)
+		else:
+			pos = row.find(WHITE, start)
+		if pos < 0:
+			return self.width
+		return pos
+
+	def add_row(self, row):
+		width = self.width
+		ref = self._reference
+		bits = self._bits
+		find = self._find_change
+
+		a0 = 0
+		# The colour of a0, the imaginary pixel in front of the row is white
+		color = WHITE
+		a1 = find(row, 0, WHITE)
+		b1 = find(ref, 0, WHITE)
+
+		while True:
+			if b1 < width:
+				b2 = find(ref, b1, ref[b1])
+			else:
+				b2 = width
+
+			if b2 < a1:
+				# Pass mode
+				bits.append(_PASS)
+				a0 = b2
+			else:
+				d = b1 - a1
+				if -3 <= d <= 3:
+					bits.append(_VERTICAL[d + 3])
+					a0 = a1
+				else:
+					if a1 < width:
+						a2 = find(row, a1, row[a1])
+					else:
+						a2 = width
+					bits.append(_HORIZONTAL)
+					if color == WHITE:
+						bits.append(_run_codes(a1 - a0, _WHITE_CODES))
+						bits.append(_run_codes(a2 - a1, _BLACK_CODES))
+					else:
+						bits.append(_run_codes(a1 - a0, _BLACK_CODES))
+						bits.append(_run_codes(a2 - a1, _WHITE_CODES))
+					a0 = a2
+
+			if a0 >= width:
+				break
+
+			color = row[a0]
+			a1 = find(row, a0, color)
+			# b1 is the next change to the other colour after a0
+			b1 = find(ref, a0, ref[a0])
+			if b1 < width and ref[b1] == color:
+				b1 = find(ref, b1, color)
+
+		self._reference = row
+
+	def take_data(self):
+		"""Returns the complete bytes that have been encoded so far."""
+		bits = ''.join(self._bits)
+		full = len(bits) - len(bits) % 8
+		self._bits = [bits[full:]]
+		return _bits_to_bytes(bits[:full])
+
+	def finish(self):
+		"""Ends the data and returns the remaining bytes."""
+		self._bits.append(_EOFB)
+		bits = ''.join(self._bits)
+		bits += '0' * (-len(bits) % 8)
+		self._bits = []
+		return _bits_to_bytes(bits)
+
+def encode_g4(rows, width):
+	"""Returns the Group 4 encoded data for a list of rows."""
+	encoder = G4Encoder(width)
+	for row in rows:
+		encoder.add_row(row)
+	return encoder.take_data() + encoder.finish()
+
+# TIFF tags and field types
+_NEW_SUBFILE_TYPE = 254
+_IMAGE_WIDTH = 256
+_IMAGE_LENGTH = 257
+_BITS_PER_SAMPLE = 258
+_COMPRESSION = 259
+_PHOTOMETRIC = 262
+_STRIP_OFFSETS = 273
+_SAMPLES_PER_PIXEL = 277
+_ROWS_PER_STRIP = 278
+_STRIP_BYTE_COUNTS = 279
+_X_RESOLUTION = 282
+_Y_RESOLUTION = 283
+_T6_OPTIONS = 293
+_RESOLUTION_UNIT = 296
+_PAGE_NUMBER = 297
+
+_SHORT = 3
+_LONG = 4
+_RATIONAL = 5
+
+class TIFFWriter(object):
+	"""Writes a multipage TIFF file. Every page is a single Group 4
+	compressed strip, the data is written as it is passed in."""
+
+	def __init__(self, filename, dpi=300):
+		self.dpi = dpi
+		self._file = open(filename, 'wb')
+		self._pages = 0
+
+		# Little endian header, the offset of the first IFD follows
+		self._file.write('II*\x00')
+		self._next_ifd_pos = self._file.tell()
+		self._file.write(struct.pack('<I', 0))
+
+	def add_page(self, width, height, chunks):
+		"""Add a page of the given size in pixels. chunks is an iterable of
+		strings with the Group 4 encoded data, e.g. a generator that encodes
+		the page while it is written."""
+		f = self._file
+
+		data_offset = f.tell()
+		for chunk in chunks:
+			f.write(chunk)
+		data_length = f.tell() - data_offset
+		# The IFD has to start on a word boundary
+		if f.tell() % 2:
+			f.write('\x00')
+
+		resolution_offset = f.tell()
+		f.write(struct.pack('<II', self.dpi, 1))
+
+		entries = [
+			(_NEW_SUBFILE_TYPE, _LONG, 1, 2),
+			(_IMAGE_WIDTH, _LONG, 1, width),
+			(_IMAGE_LENGTH, _LONG, 1, height),
+			(_BITS_PER_SAMPLE, _SHORT, 1, 1),
+			(_COMPRESSION, _SHORT, 1, 4),
+			# WhiteIsZero
+			(_PHOTOMETRIC, _SHORT, 1, 0),
+			(_STRIP_OFFSETS, _LONG, 1, data_offset),
+			(_SAMPLES_PER_PIXEL, _SHORT, 1, 1),
+			(_ROWS_PER_STRIP, _LONG, 1, height),
+			(_STRIP_BYTE_COUNTS, _LONG, 1, data_length),
+			(_X_RESOLUTION, _RATIONAL, 1, resolution_offset),
+			(_Y_RESOLUTION, _RATIONAL, 1, resolution_offset),
+			(_T6_OPTIONS, _LONG, 1, 0),
+			# Inch
+			(_RESOLUTION_UNIT, _SHORT, 1, 2),
+			# The number of pages is not known yet
+			(_PAGE_NUMBER, _SHORT, 2, self._pages),
+		]
+
+		ifd_offset = f.tell()
+		f.write(struct.pack('<H', len(entries)))
+		for tag, type, count, value in entries:
+			if type == _SHORT:
+				# One or two values, left aligned in the field
+				value = struct.pack('<HH', value, 0)
+			else:
+				value = struct.pack('<I', value)
+			f.write(struct.pack('<HHI', tag, type, count) + value)
+		next_ifd_pos = f.tell()
+		f.write(struct.pack('<I', 0))
+
+		# Link the new IFD from the previous one
+		f.seek(self._next_ifd_pos)
+		f.write(struct.pack('<I', ifd_offset))
+		f.seek(0, 2)
+
+		self._next_ifd_pos = next_ifd_pos
+		self._pages += 1
+
+	def close(self):
+		self._file.close()